@@ -0,0 +1,354 @@
+"""Microbenchmarks for knowledge_base_service retrieval.
+
+Generates synthetic corpora and measures, for every combination of corpus size,
+embedding dimension and n_results:
+
+- startup: loading data/documents.json the way the service does at import
+- ingest: one /ingest call, including the full documents.json rewrite
+- query: latency of each retrieval path, plus index build time and memory
+
+Results are written as JSON and CSV under benchmarks/results with a stable schema,
+so runs can be diffed or compared with ``--baseline``.
+
+Usage:
+    python benchmarks/kb_microbench.py --sizes 1000,10000,100000 --dims 768 --n-results 3,10
+"""
+import argparse
+import asyncio
+import atexit
+import csv
+import gc
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+import serve
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Rough in-process size of one float held in a Python list (pointer + float object)
+PY_FLOAT_BYTES = 32
+
+
+def make_corpus(size: int, dim: int, seed: int) -> List[Dict[str, Any]]:
+    """Synthetic documents shaped like the entries of DOCUMENTS"""
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((size, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    corpus = []
+    for i in range(size):
+        corpus.append({
+            "id": f"doc-{i}",
+            "content": f"Synthetic document {i} " + "lorem ipsum " * 20,
+            "metadata": {"source": "kb_microbench", "index": i},
+            "embedding": vectors[i].tolist(),
+        })
+    return corpus
+
+
+def make_queries(count: int, dim: int, seed: int) -> List[List[float]]:
+    rng = np.random.default_rng(seed + 1)
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.tolist()
+
+
+class RetrievalPath:
+    """A way of answering a query: build an index from DOCUMENTS, then search it"""
+
+    def __init__(self, name: str, build: Callable[[List[Dict[str, Any]]], Any],
+                 search: Callable[[Any, List[float], int], List[str]],
+                 size: Optional[Callable[[Any], int]] = None):
+        self.name = name
+        self.build = build
+        self.search = search
+        # Bytes scanned per query, for indexes whose vectors are memory-mapped rather than allocated
+        self.size = size
+
+
+def load_corpus(kb, corpus: List[Dict[str, Any]]):
+    """Make the corpus the writer's documents"""
+    kb.DOCUMENTS.clear()
+    kb.DOCUMENT_INDEX.clear()
+    kb.EMBEDDINGS.clear()
+    kb.add_documents(corpus)
+
+
+def retrieval_paths(kb, workdir: str, rerank_factor: int) -> List[RetrievalPath]:
+    """Retrieval paths exercised by the benchmark"""
+
+    def handler_build(documents):
+        load_corpus(kb, documents)
+        with kb.INDEX_STORE.write_lock():
+            kb.publish_documents()
+        return kb
+
+    def handler_search(module, query, k):
+        module.generate_embedding = lambda text: query
+        response = asyncio.run(module.query_knowledge_base(module.QueryRequest(query="benchmark", n_results=k)))
+        return [doc.id for doc in response.documents]
+
+    def python_search(documents, query, k):
+        scored = [(doc["id"], kb.cosine_similarity(query, doc["embedding"])) for doc in documents]
+        scored.sort(key=lambda x: x[1], reverse=True)
+        return [doc_id for doc_id, _ in scored[:k]]
+
+    def numpy_build(documents):
+        matrix = np.asarray([doc["embedding"] for doc in documents], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return [doc["id"] for doc in documents], matrix / norms
+
+    def numpy_search(index, query, k):
+        ids, matrix = index
+        scores = matrix @ np.asarray(query, dtype=np.float32)
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [ids[i] for i in top[np.argsort(-scores[top])]]
+
+    def index_build(quantization):
+        def build(documents):
+            store = kb.IndexStore(tempfile.mkdtemp(prefix=f"index-{quantization}-", dir=workdir),
+                                  quantization=quantization)
+            store.publish(documents, [doc["embedding"] for doc in documents])
+            # The product quantizer is trained in the background; include it in the build
+            store.wait_for_quantizer()
+            return store.snapshot
+        return build
+
+    def index_search(snapshot, query, k):
+        return [snapshot.documents[i]["id"] for i, _ in snapshot.search(query, k, rerank_factor=rerank_factor)]
+
+    return [
+        # The full /query handler: shared index search and response model construction
+        RetrievalPath("query_handler", handler_build, handler_search),
+        # The pure-Python cosine loop the handler used before the shared index
+        RetrievalPath("python_cosine", lambda documents: documents, python_search),
+        # Vectorised reference, to show the headroom of the hot path
+        RetrievalPath("numpy_matmul", numpy_build, numpy_search),
+        # The shared index with each quantization, re-ranking a shortlist exactly
+        *[RetrievalPath(f"index_{quantization}", index_build(quantization), index_search,
+                        lambda snapshot: snapshot.search_bytes)
+          for quantization in ("none", "int8", "pq")],
+    ]
+
+
+def _timings(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "mean_ms": statistics.mean(ordered) * 1000.0,
+        "p50_ms": ordered[len(ordered) // 2] * 1000.0,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000.0,
+        "min_ms": ordered[0] * 1000.0,
+    }
+
+
+def _measure_memory(func: Callable[[], Any]):
+    """Run func under tracemalloc and return (result, seconds, retained bytes, peak bytes)"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, current, peak
+
+
+def bench_startup(kb, corpus: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Write the corpus as documents.json and time the writer's startup: load it, convert the
+    embeddings and publish (and quantize) an index generation"""
+    load_corpus(kb, corpus)
+    kb.save_documents()
+    path = os.path.abspath(kb.DOCUMENT_PATH)
+    load_corpus(kb, [])
+
+    _, seconds, retained, peak = _measure_memory(kb.load_documents)
+    return {
+        "file_bytes": os.path.getsize(path),
+        "load_seconds": seconds,
+        "memory_bytes": retained,
+        "peak_memory_bytes": peak,
+    }
+
+
+def bench_ingest(kb, corpus: List[Dict[str, Any]], dim: int, repeats: int) -> Dict[str, Any]:
+    """Time /ingest calls against a corpus of the given size"""
+    embedding = make_queries(1, dim, seed=0)[0]
+    kb.generate_embedding = lambda text: embedding
+    samples = []
+    for i in range(repeats):
+        load_corpus(kb, corpus)
+        document = kb.DocumentInput(content=f"Ingested document {i}", metadata={"source": "kb_microbench"})
+        start = time.perf_counter()
+        asyncio.run(kb.ingest_document(document))
+        samples.append(time.perf_counter() - start)
+    return _timings(samples)
+
+
+def bench_query(path: RetrievalPath, corpus: List[Dict[str, Any]], queries: List[List[float]],
+                n_results: List[int], reference: Dict[int, List[List[str]]]) -> List[Dict[str, Any]]:
+    """Build the path's index, then time its queries for each n_results"""
+    index, build_seconds, index_bytes, peak_bytes = _measure_memory(lambda: path.build(corpus))
+    if path.size is not None:
+        index_bytes = path.size(index)
+    rows = []
+    for k in n_results:
+        samples, recalls = [], []
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            ids = path.search(index, query, k)
+            samples.append(time.perf_counter() - start)
+            expected = reference.get(k)
+            if expected is not None:
+                recalls.append(len(set(ids) & set(expected[i])) / max(1, len(expected[i])))
+        if k not in reference:
+            reference[k] = [path.search(index, query, k) for query in queries]
+            recalls = [1.0]
+        rows.append({
+            "path": path.name,
+            "n_results": k,
+            "build_seconds": build_seconds,
+            "index_bytes": index_bytes,
+            "index_peak_bytes": peak_bytes,
+            "recall": statistics.mean(recalls) if recalls else None,
+            "qps": len(samples) / sum(samples) if sum(samples) > 0 else 0.0,
+            **_timings(samples),
+        })
+    return rows
+
+
+def run(args) -> List[Dict[str, Any]]:
+    workdir = tempfile.mkdtemp(prefix="kb-microbench-")
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    os.makedirs(os.path.join(workdir, "data"))
+    kb = serve.load_service("knowledge_base", data_dir=os.path.join(workdir, "data"))
+    handler_embedding = kb.generate_embedding
+    paths = [path for path in retrieval_paths(kb, workdir, args.rerank_factor)
+             if not args.paths or path.name in args.paths]
+
+    rows = []
+    for dim in args.dims:
+        for size in args.sizes:
+            estimate = size * dim * PY_FLOAT_BYTES
+            if estimate > args.max_memory_gb * 1024 ** 3:
+                print(f"skip size={size} dim={dim}: ~{estimate / 1024 ** 3:.1f} GB of Python floats "
+                      f"exceeds --max-memory-gb {args.max_memory_gb}")
+                rows.append({"size": size, "dim": dim, "kind": "skipped", "estimated_bytes": estimate})
+                continue
+
+            print(f"size={size} dim={dim}")
+            corpus, _, corpus_bytes, _ = _measure_memory(lambda: make_corpus(size, dim, args.seed))
+            queries = make_queries(args.queries, dim, args.seed)
+            base = {"size": size, "dim": dim, "corpus_bytes": corpus_bytes,
+                    "bytes_per_document": corpus_bytes / size}
+
+            startup = bench_startup(kb, corpus)
+            rows.append({**base, "kind": "startup", **startup})
+            print(f"  startup: {startup['load_seconds']:.2f}s for {startup['file_bytes'] / 1024 ** 2:.1f} MB")
+
+            if size <= args.max_ingest_size:
+                ingest = bench_ingest(kb, corpus, dim, args.ingest_repeats)
+                kb.generate_embedding = handler_embedding
+                rows.append({**base, "kind": "ingest", **ingest})
+                print(f"  ingest: p50 {ingest['p50_ms']:.1f} ms")
+
+            # The vectorised path is exact, so it is the recall reference when present
+            reference: Dict[int, List[List[str]]] = {}
+            ordered = sorted(paths, key=lambda path: path.name != "numpy_matmul")
+            for path in ordered:
+                for row in bench_query(path, corpus, queries, args.n_results, reference):
+                    rows.append({**base, "kind": "query", **row})
+                    print(f"  query {row['path']:<14} k={row['n_results']:<3} p50 {row['p50_ms']:8.2f} ms"
+                          f"  build {row['build_seconds']:.2f}s  index {row['index_bytes'] / 1024 ** 2:.1f} MB")
+            load_corpus(kb, [])
+            kb.generate_embedding = handler_embedding
+            del corpus
+            gc.collect()
+    return rows
+
+
+def _key(row: Dict[str, Any]):
+    return row["kind"], row["size"], row["dim"], row.get("path"), row.get("n_results")
+
+
+def compare_with_baseline(rows: List[Dict[str, Any]], baseline_path: str, threshold: float) -> bool:
+    """Print p50 ratios against a previous run; return True if any regressed past the threshold"""
+    with open(baseline_path, "r") as f:
+        baseline = {_key(row): row for row in json.load(f)["rows"]}
+    regressed = False
+    for row in rows:
+        old = baseline.get(_key(row))
+        metric = "p50_ms" if "p50_ms" in row else "load_seconds"
+        if not old or metric not in row or not old.get(metric):
+            continue
+        ratio = row[metric] / old[metric]
+        flag = " !" if ratio > 1.0 + threshold else ""
+        regressed = regressed or bool(flag)
+        print(f"{row['kind']:<8}{row['size']:>9}{row['dim']:>6} {row.get('path') or '':<14}"
+              f"{row.get('n_results') or '':>4} {metric} x{ratio:.2f}{flag}")
+    return regressed
+
+
+def save(rows: List[Dict[str, Any]], args) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stem = os.path.join(RESULTS_DIR, f"kb_micro-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{args.label}")
+    with open(stem + ".json", "w") as f:
+        json.dump({
+            "label": args.label,
+            "timestamp": datetime.now().isoformat(),
+            "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+            "config": {key: value for key, value in vars(args).items()},
+            "rows": rows,
+        }, f, indent=2)
+    columns = sorted({column for row in rows for column in row})
+    with open(stem + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    return stem
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for knowledge base retrieval")
+    parser.add_argument("--sizes", type=_int_list, default=[1000, 10000, 100000],
+                        help="Corpus sizes, e.g. 1000,10000,100000,1000000")
+    parser.add_argument("--dims", type=_int_list, default=[768], help="Embedding dimensions")
+    parser.add_argument("--n-results", type=_int_list, default=[3, 10])
+    parser.add_argument("--queries", type=int, default=20, help="Queries timed per configuration")
+    parser.add_argument("--paths", type=lambda value: value.split(","), default=None,
+                        help="Only run these retrieval paths")
+    parser.add_argument("--rerank-factor", type=int, default=10,
+                        help="Shortlist size per result re-ranked exactly by the quantized index paths")
+    parser.add_argument("--ingest-repeats", type=int, default=3)
+    parser.add_argument("--max-ingest-size", type=int, default=100000,
+                        help="Skip /ingest timing above this size (each call rewrites the whole file)")
+    parser.add_argument("--max-memory-gb", type=float, default=8.0,
+                        help="Skip configurations whose Python-list corpus would exceed this")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--baseline", default=None, help="Previous kb_micro JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    rows = run(args)
+    print(f"\nSaved results to {save(rows, args)}.{{json,csv}}")
+    if args.baseline and compare_with_baseline(rows, args.baseline, args.threshold):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""End-to-end load test for the four-service stack.
+
+Replays a JSONL workload against /chat, /query, /search and /history, and reports
+throughput and p50/p95/p99 latency per endpoint and per internal stage (taken from
+the ``Server-Timing`` response headers). Each run is saved under benchmarks/results
+so that two runs can be compared for regressions.
+
+Usage:
+    python benchmarks/loadtest.py run --workload benchmarks/workloads/sample.jsonl --requests 500 --label baseline
+    python benchmarks/loadtest.py compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# Service ports used when the harness starts the stack itself
+SERVICE_PORTS = {
+    "chat": 8100,
+    "knowledge_base": 8101,
+    "search": 8102,
+    "history": 8103,
+}
+
+# Which service owns each endpoint prefix
+ENDPOINT_SERVICES = {
+    "/chat": "chat",
+    "/generate-lecture": "chat",
+    "/query": "knowledge_base",
+    "/ingest": "knowledge_base",
+    "/search": "search",
+    "/history": "history",
+}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds"""
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) if values else 0.0,
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "max_ms": max(values) if values else 0.0,
+    }
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """Parse a Server-Timing header into {stage: milliseconds}"""
+    stages = {}
+    if not header:
+        return stages
+    for entry in header.split(","):
+        parts = [part.strip() for part in entry.split(";")]
+        name = parts[0]
+        for part in parts[1:]:
+            if part.startswith("dur="):
+                try:
+                    stages[name] = stages.get(name, 0.0) + float(part[4:])
+                except ValueError:
+                    pass
+    return stages
+
+
+def load_workload(path: str) -> List[Dict[str, Any]]:
+    """Load a JSONL workload.
+
+    Lines are either explicit requests ({"endpoint": "/query", "method": "POST", "body": {...}})
+    or free-text records such as the backlog entries ({"title": ..., "body": "..."}),
+    which are replayed as /chat messages.
+    """
+    items = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "endpoint" in record:
+                items.append({
+                    "endpoint": record["endpoint"],
+                    "method": record.get("method", "POST").upper(),
+                    "body": record.get("body"),
+                })
+            else:
+                text = record.get("title") or record.get("body") or ""
+                items.append({"endpoint": "/chat", "method": "POST", "body": {"message": text}})
+    if not items:
+        raise ValueError(f"Workload {path} is empty")
+    return items
+
+
+def service_for(endpoint: str) -> str:
+    """Find the service that serves an endpoint"""
+    for prefix, service in ENDPOINT_SERVICES.items():
+        if endpoint == prefix or endpoint.startswith(prefix + "/"):
+            return service
+    raise ValueError(f"Unknown endpoint: {endpoint}")
+
+
+def endpoint_label(method: str, endpoint: str) -> str:
+    """Label requests by their workload template, so /history/{chat_id} is one endpoint"""
+    return f"{method} {endpoint}"
+
+
+class Stack:
+    """Start the four services against local stand-ins, one process each"""
+
+    def __init__(self, ports: Dict[str, int], env: Dict[str, str]):
+        self.ports = ports
+        self.env = env
+        self.processes: List[subprocess.Popen] = []
+
+    def urls(self) -> Dict[str, str]:
+        return {service: f"http://127.0.0.1:{port}" for service, port in self.ports.items()}
+
+    def start(self, timeout: float = 60.0):
+        urls = self.urls()
+        env = dict(os.environ)
+        env.update(self.env)
+        env.update({
+            "KNOWLEDGE_BASE_URL": urls["knowledge_base"],
+            "SEARCH_URL": urls["search"],
+            "HISTORY_URL": urls["history"],
+        })
+        for service, port in self.ports.items():
+            self.processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(BENCH_DIR, "serve.py"), service, "--port", str(port)],
+                env=env,
+            ))
+        deadline = time.monotonic() + timeout
+        for service, url in urls.items():
+            while True:
+                try:
+                    if httpx.get(url + "/", timeout=1.0).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"{service} did not become ready at {url}")
+                time.sleep(0.2)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+
+
+async def _create_chat_ids(client: httpx.AsyncClient, history_url: str, count: int) -> List[str]:
+    """Create chat sessions to substitute for {chat_id} in the workload"""
+    chat_ids = []
+    for _ in range(count):
+        response = await client.post(f"{history_url}/history")
+        response.raise_for_status()
+        chat_ids.append(response.json()["chat_id"])
+    return chat_ids
+
+
+async def replay(workload: List[Dict[str, Any]], urls: Dict[str, str], total_requests: int,
+                 concurrency: int, warmup: int, timeout: float) -> Dict[str, Any]:
+    """Replay the workload with a fixed number of concurrent closed-loop clients"""
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    stage_latencies: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+    errors: Dict[str, int] = defaultdict(int)
+    counter = {"next": 0}
+
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        chat_ids = await _create_chat_ids(client, urls["history"], max(1, concurrency))
+
+        def build(index: int):
+            item = workload[index % len(workload)]
+            chat_id = chat_ids[index % len(chat_ids)]
+            endpoint = item["endpoint"].replace("{chat_id}", chat_id)
+            body = json.loads(json.dumps(item["body"]).replace("{chat_id}", chat_id)) if item["body"] else None
+            url = urls[service_for(item["endpoint"])] + endpoint
+            return endpoint_label(item["method"], item["endpoint"]), item["method"], url, body
+
+        async def send(index: int, record: bool):
+            label, method, url, body = build(index)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, json=body)
+                elapsed = (time.perf_counter() - start) * 1000.0
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                elapsed = (time.perf_counter() - start) * 1000.0
+                response, ok = None, False
+            if not record:
+                return
+            latencies[label].append(elapsed)
+            if not ok:
+                errors[label] += 1
+            if response is not None:
+                for stage, ms in parse_server_timing(response.headers.get("Server-Timing")).items():
+                    stage_latencies[label][stage].append(ms)
+
+        for index in range(warmup):
+            await send(index, record=False)
+
+        async def worker():
+            while True:
+                index = counter["next"]
+                if index >= total_requests:
+                    return
+                counter["next"] += 1
+                await send(warmup + index, record=True)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+
+    endpoints = {}
+    for label, values in sorted(latencies.items()):
+        endpoints[label] = {
+            **summarize(values),
+            "errors": errors.get(label, 0),
+            "throughput_rps": len(values) / wall if wall > 0 else 0.0,
+            "stages": {stage: summarize(ms) for stage, ms in sorted(stage_latencies[label].items())},
+        }
+    all_values = [value for values in latencies.values() for value in values]
+    return {
+        "wall_seconds": wall,
+        "total": {**summarize(all_values), "errors": sum(errors.values()),
+                  "throughput_rps": len(all_values) / wall if wall > 0 else 0.0},
+        "endpoints": endpoints,
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    """Print a run as a table"""
+    header = f"{'endpoint / stage':<40}{'count':>8}{'rps':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'err':>6}"
+    print(header)
+    print("-" * len(header))
+    for label, stats in result["endpoints"].items():
+        print(f"{label:<40}{stats['count']:>8}{stats['throughput_rps']:>9.1f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['errors']:>6}")
+        for stage, stage_stats in stats["stages"].items():
+            print(f"  {stage:<38}{stage_stats['count']:>8}{'':>9}"
+                  f"{stage_stats['p50_ms']:>10.1f}{stage_stats['p95_ms']:>10.1f}{stage_stats['p99_ms']:>10.1f}")
+    total = result["total"]
+    print("-" * len(header))
+    print(f"{'total':<40}{total['count']:>8}{total['throughput_rps']:>9.1f}"
+          f"{total['p50_ms']:>10.1f}{total['p95_ms']:>10.1f}{total['p99_ms']:>10.1f}{total['errors']:>6}")
+
+
+def save_run(run: Dict[str, Any], label: str) -> str:
+    """Store a run so it can be compared with later ones"""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(RESULTS_DIR, f"{stamp}-{label}.json")
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2)
+    return path
+
+
+def compare_runs(old: Dict[str, Any], new: Dict[str, Any], threshold: float) -> bool:
+    """Print per-endpoint and per-stage deltas; return True if any p95 regressed past the threshold"""
+    regressed = False
+    print(f"{'endpoint / stage':<40}{'old p95':>10}{'new p95':>10}{'delta':>9}")
+    for label, new_stats in new["result"]["endpoints"].items():
+        old_stats = old["result"]["endpoints"].get(label)
+        if not old_stats:
+            print(f"{label:<40}{'-':>10}{new_stats['p95_ms']:>10.1f}")
+            continue
+        rows = [(label, old_stats, new_stats)]
+        rows += [(f"  {stage}", old_stats["stages"].get(stage), stats) for stage, stats in new_stats["stages"].items()]
+        for name, before, after in rows:
+            if not before or not before["p95_ms"]:
+                continue
+            delta = (after["p95_ms"] - before["p95_ms"]) / before["p95_ms"]
+            flag = " !" if delta > threshold else ""
+            regressed = regressed or bool(flag)
+            print(f"{name:<40}{before['p95_ms']:>10.1f}{after['p95_ms']:>10.1f}{delta:>+9.0%}{flag}")
+    old_rps, new_rps = old["result"]["total"]["throughput_rps"], new["result"]["total"]["throughput_rps"]
+    print(f"\nThroughput: {old_rps:.1f} -> {new_rps:.1f} req/s")
+    return regressed
+
+
+def run_command(args):
+    workload = load_workload(args.workload)
+    stack = None
+    if args.no_stack:
+        urls = {
+            "chat": args.chat_url,
+            "knowledge_base": args.kb_url,
+            "search": args.search_url,
+            "history": args.history_url,
+        }
+    else:
+        stack = Stack(SERVICE_PORTS, {
+            "BENCH_GEMINI_GENERATE_MS": str(args.gemini_ms),
+            "BENCH_GEMINI_EMBED_MS": str(args.embed_ms),
+            "BENCH_DDG_SEARCH_MS": str(args.search_ms),
+            "BENCH_MONGO_OP_MS": str(args.mongo_ms),
+        })
+        stack.start()
+        urls = stack.urls()
+    try:
+        result = asyncio.run(replay(workload, urls, args.requests, args.concurrency, args.warmup, args.timeout))
+    finally:
+        if stack:
+            stack.stop()
+
+    print_report(result)
+    run = {
+        "label": args.label,
+        "timestamp": datetime.now().isoformat(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {key: value for key, value in vars(args).items() if key != "func"},
+        "result": result,
+    }
+    print(f"\nSaved run to {save_run(run, args.label)}")
+
+
+def compare_command(args):
+    with open(args.old, "r") as f:
+        old = json.load(f)
+    with open(args.new, "r") as f:
+        new = json.load(f)
+    if compare_runs(old, new, args.threshold):
+        print(f"\np95 regression above {args.threshold:.0%} detected")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the AI Agent MVP services")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Replay a workload and store the run")
+    run.add_argument("--workload", default=os.path.join(BENCH_DIR, "workloads", "sample.jsonl"))
+    run.add_argument("--requests", type=int, default=200, help="Number of measured requests")
+    run.add_argument("--concurrency", type=int, default=8)
+    run.add_argument("--warmup", type=int, default=10)
+    run.add_argument("--timeout", type=float, default=60.0)
+    run.add_argument("--label", default="run")
+    run.add_argument("--gemini-ms", type=float, default=400.0, help="Simulated Gemini generation latency")
+    run.add_argument("--embed-ms", type=float, default=40.0, help="Simulated Gemini embedding latency")
+    run.add_argument("--search-ms", type=float, default=300.0, help="Simulated DuckDuckGo latency")
+    run.add_argument("--mongo-ms", type=float, default=1.0, help="Simulated MongoDB operation latency")
+    run.add_argument("--no-stack", action="store_true", help="Target already running services")
+    run.add_argument("--chat-url", default="http://localhost:8000")
+    run.add_argument("--kb-url", default="http://localhost:8001")
+    run.add_argument("--search-url", default="http://localhost:8002")
+    run.add_argument("--history-url", default="http://localhost:8003")
+    run.set_defaults(func=run_command)
+
+    compare = commands.add_parser("compare", help="Compare two stored runs")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=0.10, help="Allowed relative p95 increase")
+    compare.set_defaults(func=compare_command)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
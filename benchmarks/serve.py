@@ -0,0 +1,84 @@
+"""Run one of the services with Gemini, DuckDuckGo and MongoDB replaced by local stand-ins.
+
+Usage:
+    python benchmarks/serve.py <chat|knowledge_base|search|history> --port 8000
+
+The services report the time spent in each internal stage of a request in their
+``Server-Timing`` response headers, which the load tester aggregates per stage.
+"""
+import argparse
+import atexit
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+
+import uvicorn
+
+import stubs
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules shared by all services
+COMMON_DIR = os.path.join(REPO_ROOT, "common")
+
+SERVICE_DIRS = {
+    "chat": "chat_service",
+    "knowledge_base": "knowledge_base_service",
+    "search": "search_service",
+    "history": "history_service",
+}
+
+
+def _prepare_workdir(service: str, data_dir: str = None) -> str:
+    """Create a scratch working directory so benchmark writes never touch the repo data"""
+    workdir = tempfile.mkdtemp(prefix=f"bench-{service}-")
+    source = data_dir or os.path.join(REPO_ROOT, SERVICE_DIRS[service], "data")
+    if os.path.isdir(source):
+        shutil.copytree(source, os.path.join(workdir, "data"))
+    return workdir
+
+
+def load_service(service: str, data_dir: str = None):
+    """Import a service's app module with its external dependencies stubbed out"""
+    service_dir = os.path.join(REPO_ROOT, SERVICE_DIRS[service])
+    workdir = _prepare_workdir(service, data_dir)
+    # The scratch directory only lives as long as the process
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    os.chdir(workdir)
+    sys.path.insert(0, COMMON_DIR)
+    sys.path.insert(0, service_dir)
+
+    # Patch the client constructors before the module creates its globals
+    if service in ("chat", "knowledge_base"):
+        from google import genai
+        genai.Client = stubs.FakeGeminiClient
+    if service == "history":
+        import pymongo
+        pymongo.MongoClient = lambda *args, **kwargs: {os.getenv("DB_NAME", "ai_agent_mvp"): {
+            os.getenv("COLLECTION_NAME", "chat_history"): stubs.FakeCollection()
+        }}
+
+    spec = importlib.util.spec_from_file_location(f"{service}_app", os.path.join(service_dir, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    if service == "search":
+        module.DDGS = stubs.FakeDDGS
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a service against local stand-ins")
+    parser.add_argument("service", choices=sorted(SERVICE_DIRS))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--data-dir", default=None, help="Directory copied as the service's ./data")
+    args = parser.parse_args()
+
+    module = load_service(args.service, args.data_dir)
+    uvicorn.run(module.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
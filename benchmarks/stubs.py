@@ -0,0 +1,119 @@
+"""Local stand-ins for Gemini, DuckDuckGo and MongoDB used by the benchmark harness.
+
+Every stand-in answers deterministically after a configurable simulated latency,
+so a run only measures our own services and is reproducible on a single box.
+"""
+import hashlib
+import math
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+# Simulated latencies of the external dependencies, in milliseconds
+GEMINI_GENERATE_MS = float(os.getenv("BENCH_GEMINI_GENERATE_MS", "400"))
+GEMINI_EMBED_MS = float(os.getenv("BENCH_GEMINI_EMBED_MS", "40"))
+DDG_SEARCH_MS = float(os.getenv("BENCH_DDG_SEARCH_MS", "300"))
+MONGO_OP_MS = float(os.getenv("BENCH_MONGO_OP_MS", "1"))
+EMBEDDING_DIM = int(os.getenv("BENCH_EMBEDDING_DIM", "768"))
+
+
+def _simulate(latency_ms: float):
+    """Block for the simulated latency, like the real synchronous SDK calls do"""
+    if latency_ms > 0:
+        time.sleep(latency_ms / 1000.0)
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> List[float]:
+    """Deterministic unit-length pseudo embedding derived from the text's words"""
+    vector = [0.0] * dim
+    for word in text.lower().split():
+        seed = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+        rng = random.Random(seed)
+        for _ in range(8):
+            vector[rng.randrange(dim)] += rng.uniform(-1.0, 1.0)
+    norm = math.sqrt(sum(x * x for x in vector))
+    if norm == 0:
+        return vector
+    return [x / norm for x in vector]
+
+
+# Gemini
+class _GenerateResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _EmbedResult:
+    def __init__(self, embedding: List[float]):
+        self.embedding = embedding
+
+
+class _FakeModels:
+    def generate_content(self, model: str, contents: Any) -> _GenerateResponse:
+        _simulate(GEMINI_GENERATE_MS)
+        prompt = contents if isinstance(contents, str) else str(contents)
+        digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:12]
+        return _GenerateResponse(f"[stub answer {digest}] " + " ".join(prompt.split()[:60]))
+
+    def list(self):
+        return []
+
+
+class _FakeEmbeddingModel:
+    def embed_content(self, content: str, task_type: str = "retrieval_document") -> _EmbedResult:
+        _simulate(GEMINI_EMBED_MS)
+        return _EmbedResult(fake_embedding(content))
+
+
+class FakeGeminiClient:
+    """Replacement for google.genai.Client as used by chat_service and knowledge_base_service"""
+
+    def __init__(self, *args, **kwargs):
+        self.models = _FakeModels()
+
+    def get_model(self, name: str) -> _FakeEmbeddingModel:
+        return _FakeEmbeddingModel()
+
+
+# DuckDuckGo
+class FakeDDGS:
+    """Replacement for duckduckgo_search.DDGS"""
+
+    def text(self, keywords: str, region: str = "wt-wt", safesearch: str = "moderate",
+             timelimit: Optional[str] = None, max_results: Optional[int] = None) -> List[Dict[str, str]]:
+        _simulate(DDG_SEARCH_MS)
+        slug = "-".join(keywords.lower().split())[:40]
+        return [
+            {
+                "title": f"Result {i + 1} for {keywords}",
+                "href": f"https://example.com/{slug}/{i + 1}",
+                "body": f"Synthetic search snippet {i + 1} about {keywords}. " * 4,
+            }
+            for i in range(max_results or 5)
+        ]
+
+
+# MongoDB
+class FakeCollection:
+    """In-memory replacement for the pymongo collection used by history_service"""
+
+    def __init__(self):
+        self._docs: Dict[str, Dict[str, Any]] = {}
+
+    def insert_one(self, document: Dict[str, Any]):
+        _simulate(MONGO_OP_MS)
+        self._docs[document["chat_id"]] = dict(document)
+
+    def find_one(self, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        _simulate(MONGO_OP_MS)
+        document = self._docs.get(query.get("chat_id"))
+        return dict(document) if document is not None else None
+
+    def update_one(self, query: Dict[str, Any], update: Dict[str, Any], upsert: bool = False):
+        _simulate(MONGO_OP_MS)
+        chat_id = query.get("chat_id")
+        if chat_id not in self._docs and not upsert:
+            return
+        document = self._docs.setdefault(chat_id, {"chat_id": chat_id})
+        document.update(update.get("$set", {}))
@@ -1,12 +1,27 @@
 import os
 import json
+import asyncio
 from typing import List, Optional, Dict, Any
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-import httpx
 from google import genai
 from dotenv import load_dotenv
+from instrumentation import install, stage, trace_headers
+from structured_logging import install_logging, log_payload, request_id_headers
+from resilience import (
+    GENERATION_RESERVE_SECONDS, KNOWLEDGE_BASE_HEDGE_DELAY_SECONDS, close_client, downstream_request, hedged,
+    remaining_budget, start_deadline
+)
+from conversation import (
+    QUERY_REWRITE_MODE, QUERY_REWRITE_TIMEOUT_SECONDS, QUERY_REWRITES, RETRIEVALS, SESSIONS, SessionContext,
+    is_follow_up, next_subject, previous_subject, rewrite_query
+)
+from lectures import (
+    LECTURE_SECTION_CONCURRENCY, LECTURE_SECTIONS, LECTURES, LectureSections, format_lecture, format_section,
+    lecture_key, section_title
+)
 
 # Load environment variables
 load_dotenv()
@@ -36,6 +51,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request metrics, Server-Timing headers, tracing and /metrics
+install(app, "chat_service")
+
+# Structured JSON logging with request id correlation
+logger = install_logging(app, "chat_service")
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close the shared downstream connection pool"""
+    await close_client()
+
 # Models
 class Message(BaseModel):
     role: str
@@ -60,6 +86,7 @@ class LectureRequest(BaseModel):
 class LectureResponse(BaseModel):
     lecture: str
     topic: str
+    cached: bool = False
 
 # Initialize the Gemini model
 GEMINI_MODEL = "models/gemini-2.0-flash"  # Using the full model name from the available models
@@ -72,7 +99,9 @@ async def root():
         "endpoints": {
             "/chat": "Chat with the AI agent",
             "/generate-lecture": "Generate a lecture on a specific topic",
-            "/models": "List available models"
+            "/generate-lecture/stream": "Generate a lecture section by section, streamed in order",
+            "/models": "List available models",
+            "/metrics": "Prometheus metrics"
         }
     }
 
@@ -87,97 +116,136 @@ async def list_models():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing models: {str(e)}")
 
+def downstream_headers() -> Dict[str, str]:
+    """Trace context and request id headers for calls to the other services"""
+    return {**trace_headers(), **request_id_headers()}
+
 async def query_knowledge_base(query: str) -> Optional[Dict[str, Any]]:
-    """Query the knowledge base service"""
+    """Query the knowledge base service, hedging slow queries if enabled"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{KNOWLEDGE_BASE_URL}/query",
-                json={"query": query, "n_results": 3}
-            )
+        response = await hedged(
+            lambda: downstream_request(
+                "knowledge_base", "POST", f"{KNOWLEDGE_BASE_URL}/query",
+                json={"query": query, "n_results": 3},
+                headers=downstream_headers()
+            ),
+            KNOWLEDGE_BASE_HEDGE_DELAY_SECONDS
+        )
 
-            if response.status_code == 200:
-                return response.json()
-            return None
+        if response.status_code == 200:
+            return response.json()
+        return None
     except Exception as e:
-        print(f"Error querying knowledge base: {str(e)}")
+        logger.warning("Error querying knowledge base: %s", e)
         return None
 
 async def search_web(query: str) -> Optional[Dict[str, Any]]:
     """Search the web using the search service"""
     try:
-        print(f"Searching the web for: {query}")
-        print(f"Search URL: {SEARCH_URL}")
+        logger.debug("Searching the web", extra={"fields": {"query": query, "search_url": SEARCH_URL}})
 
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(
-                    f"{SEARCH_URL}/search",
-                    json={"query": query, "max_results": 3}
-                )
-
-                print(f"Search response status: {response.status_code}")
+        response = await downstream_request(
+            "search", "POST", f"{SEARCH_URL}/search",
+            json={"query": query, "max_results": 3},
+            headers=downstream_headers()
+        )
 
-                if response.status_code == 200:
-                    result = response.json()
-                    print(f"Search results: {result}")
-                    return result
-                else:
-                    print(f"Search failed with status code: {response.status_code}")
-                    print(f"Response text: {response.text}")
-                return None
-            except Exception as e:
-                print(f"Exception during search request: {str(e)}")
-                return None
+        if response.status_code == 200:
+            result = response.json()
+            log_payload(logger, "Search results", result)
+            return result
+        else:
+            logger.warning("Search failed", extra={"fields": {
+                "status_code": response.status_code,
+                "response_text": response.text[:500]
+            }})
+        return None
     except Exception as e:
-        print(f"Error searching the web: {str(e)}")
+        logger.warning("Error searching the web: %s", e)
         return None
 
 async def get_chat_history(chat_id: str) -> Optional[Dict[str, Any]]:
     """Get chat history from the history service"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{HISTORY_URL}/history/{chat_id}")
+        response = await downstream_request(
+            "history", "GET", f"{HISTORY_URL}/history/{chat_id}", headers=downstream_headers()
+        )
 
-            if response.status_code == 200:
-                return response.json()
-            return None
+        if response.status_code == 200:
+            return response.json()
+        return None
     except Exception as e:
-        print(f"Error getting chat history: {str(e)}")
+        logger.warning("Error getting chat history: %s", e)
         return None
 
 async def create_chat_session() -> Optional[Dict[str, Any]]:
     """Create a new chat session in the history service"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{HISTORY_URL}/history")
+        response = await downstream_request(
+            "history", "POST", f"{HISTORY_URL}/history", headers=downstream_headers()
+        )
 
-            if response.status_code == 200:
-                return response.json()
-            return None
+        if response.status_code == 200:
+            return response.json()
+        return None
     except Exception as e:
-        print(f"Error creating chat session: {str(e)}")
+        logger.warning("Error creating chat session: %s", e)
         return None
 
 async def add_message_to_history(chat_id: str, role: str, content: str) -> Optional[Dict[str, Any]]:
     """Add a message to chat history in the history service"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{HISTORY_URL}/history/{chat_id}/messages",
-                json={"role": role, "content": content}
-            )
+        response = await downstream_request(
+            "history", "POST", f"{HISTORY_URL}/history/{chat_id}/messages",
+            json={"role": role, "content": content},
+            headers=downstream_headers()
+        )
 
-            if response.status_code == 200:
-                return response.json()
-            return None
+        if response.status_code == 200:
+            return response.json()
+        return None
     except Exception as e:
-        print(f"Error adding message to history: {str(e)}")
+        logger.warning("Error adding message to history: %s", e)
         return None
 
+async def rewrite_follow_up(message: str, topic: str, history_context: str) -> str:
+    """Rewrite a follow-up question into a standalone retrieval query"""
+    if QUERY_REWRITE_MODE == "model":
+        # Bounded by the turn's deadline, keeping its reserve for the answer
+        remaining = remaining_budget()
+        timeout = QUERY_REWRITE_TIMEOUT_SECONDS
+        if remaining is not None:
+            timeout = min(timeout, remaining - GENERATION_RESERVE_SECONDS)
+        try:
+            if timeout <= 0:
+                raise asyncio.TimeoutError("No time budget left to rewrite the query")
+            response = await asyncio.wait_for(asyncio.to_thread(
+                client.models.generate_content,
+                model=GEMINI_MODEL,
+                contents=f"""Rewrite the follow-up question as a standalone search query. Reply with the query only.
+
+Conversation history:
+{history_context}
+Subject of the conversation: {topic}
+Follow-up question: {message}"""
+            ), timeout)
+            rewritten = response.text.strip()
+            if rewritten:
+                QUERY_REWRITES.labels("model").inc()
+                return rewritten
+        except asyncio.TimeoutError:
+            logger.warning("Rewriting query with Gemini timed out after %.2fs", max(timeout, 0))
+        except Exception as e:
+            logger.warning("Error rewriting query with Gemini: %s", e)
+
+    QUERY_REWRITES.labels("heuristic").inc()
+    return rewrite_query(message, topic)
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """Chat with the AI agent"""
+    # Budget shared by all downstream calls of this turn
+    start_deadline()
     try:
         # Get or create chat session
         chat_id = request.chat_id
@@ -185,7 +253,8 @@ async def chat(request: ChatRequest):
 
         if not chat_id:
             try:
-                chat_session = await create_chat_session()
+                with stage("history_create"):
+                    chat_session = await create_chat_session()
                 if chat_session:
                     chat_id = chat_session["chat_id"]
                 else:
@@ -194,7 +263,7 @@ async def chat(request: ChatRequest):
                     chat_id = str(uuid.uuid4())
                     history_available = False
             except Exception as e:
-                print(f"Error creating chat session: {str(e)}")
+                logger.warning("Error creating chat session: %s", e)
                 # Generate a temporary chat ID if history service is not available
                 import uuid
                 chat_id = str(uuid.uuid4())
@@ -203,30 +272,62 @@ async def chat(request: ChatRequest):
         # Add user message to history if history service is available
         if history_available:
             try:
-                await add_message_to_history(chat_id, "user", request.message)
+                with stage("history_add_user"):
+                    await add_message_to_history(chat_id, "user", request.message)
             except Exception as e:
-                print(f"Error adding message to history: {str(e)}")
+                logger.warning("Error adding message to history: %s", e)
                 history_available = False
 
         # Get chat history for context if history service is available
         history_context = ""
+        history_messages = []
         if history_available:
             try:
-                chat_history = await get_chat_history(chat_id)
+                with stage("history_get"):
+                    chat_history = await get_chat_history(chat_id)
                 if chat_history and "messages" in chat_history:
+                    history_messages = chat_history["messages"]
                     # Format the last 5 messages for context
-                    messages = chat_history["messages"][-5:]
+                    messages = history_messages[-5:]
                     for msg in messages:
                         history_context += f"{msg['role']}: {msg['content']}\n"
             except Exception as e:
-                print(f"Error getting chat history: {str(e)}")
+                logger.warning("Error getting chat history: %s", e)
                 history_available = False
 
-        # Try knowledge base first if enabled
+        # Rewrite follow-ups into standalone queries, and answer them from the context
+        # retrieved earlier in the session when it covers them
+        retrieval_query = request.message
+        session = SESSIONS.get(chat_id) if QUERY_REWRITE_MODE != "off" else None
+        topic = session.subject if session else previous_subject(history_messages, request.message)
+        follow_up = QUERY_REWRITE_MODE != "off" and topic is not None and is_follow_up(request.message)
+        if follow_up:
+            with stage("query_rewrite"):
+                retrieval_query = await rewrite_follow_up(request.message, topic, history_context)
+            logger.debug("Rewrote follow-up question", extra={"fields": {
+                "message": request.message, "retrieval_query": retrieval_query
+            }})
+        reuse = (follow_up and session is not None
+                 and session.allowed(request.use_knowledge_base, request.use_web_search)
+                 and session.covers(request.message))
+
         knowledge_context = []
+        web_results = []
         source = "gemini"
-        if request.use_knowledge_base:
-            kb_results = await query_knowledge_base(request.message)
+        if reuse:
+            RETRIEVALS.labels("reused").inc()
+            source = session.source
+            if source == "knowledge_base":
+                knowledge_context = session.context
+            else:
+                web_results = session.context
+        elif request.use_knowledge_base or request.use_web_search:
+            RETRIEVALS.labels("retrieved").inc()
+
+        # Try knowledge base first if enabled
+        if request.use_knowledge_base and not reuse:
+            with stage("kb_query"):
+                kb_results = await query_knowledge_base(retrieval_query)
             if kb_results and "documents" in kb_results and kb_results["documents"]:
                 source = "knowledge_base"
                 for doc in kb_results["documents"]:
@@ -236,11 +337,10 @@ async def chat(request: ChatRequest):
                     })
 
         # If no knowledge base results and web search is enabled, try web search
-        web_results = []
-        if not knowledge_context and request.use_web_search:
-            print(f"No knowledge base results found, trying web search for: {request.message}")
-            search_results = await search_web(request.message)
-            print(f"Web search results: {search_results}")
+        if not knowledge_context and request.use_web_search and not reuse:
+            logger.info("No knowledge base results found, trying web search")
+            with stage("web_search"):
+                search_results = await search_web(retrieval_query)
             if search_results and "results" in search_results and search_results["results"]:
                 source = "web_search"
                 for result in search_results["results"]:
@@ -250,7 +350,16 @@ async def chat(request: ChatRequest):
                         "href": result["href"]
                     })
             else:
-                print("No web search results found or invalid response format")
+                logger.info("No web search results found or invalid response format")
+
+        # Remember what was retrieved for follow-ups; a turn that found nothing ends the
+        # previous context, so later follow-ups aren't answered from an older topic
+        if not reuse and QUERY_REWRITE_MODE != "off":
+            if knowledge_context or web_results:
+                subject = next_subject(request.message, topic)
+                SESSIONS.put(chat_id, SessionContext(subject, source, knowledge_context or web_results))
+            else:
+                SESSIONS.discard(chat_id)
 
         # Prepare prompt for Gemini
         prompt = f"""You are an AI assistant. Answer the following question based on the provided context.
@@ -275,10 +384,11 @@ User question: {request.message}
         prompt += "\nPlease provide a helpful, accurate, and concise response."
 
         # Generate response with Gemini
-        response = client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=prompt
-        )
+        with stage("gemini_generate"):
+            response = client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=prompt
+            )
 
         # Get the response text
         response_text = response.text
@@ -286,9 +396,10 @@ User question: {request.message}
         # Add assistant response to history if history service is available
         if history_available:
             try:
-                await add_message_to_history(chat_id, "assistant", response_text)
+                with stage("history_add_assistant"):
+                    await add_message_to_history(chat_id, "assistant", response_text)
             except Exception as e:
-                print(f"Error adding assistant response to history: {str(e)}")
+                logger.warning("Error adding assistant response to history: %s", e)
 
         # Return the response
         context = []
@@ -320,11 +431,12 @@ async def get_chat(chat_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving chat: {str(e)}")
 
-def generate_lecture(topic: str, context: str = None):
-    """Generate a lecture on a specific topic using Google Gemini API"""
-    try:
-        # Create the template
-        template = f"""
+def lecture_template(topic: str, context: str = None) -> str:
+    """Instructions for a lecture following the five-part outline"""
+    outline = "\n".join(
+        f"        {number}. {title.format(topic=topic)}" for number, title in enumerate(LECTURE_SECTIONS, 1)
+    )
+    return f"""
         As an accomplished university professor and expert in {topic}, your task is to develop an elaborate, exhaustive, and highly detailed lecture on the subject.
         Remember to generate content ensuring both novice learners and advanced students can benefit from your expertise.
 
@@ -333,53 +445,98 @@ def generate_lecture(topic: str, context: str = None):
         {context if context else "No specific context provided. Create a comprehensive lecture based on your knowledge."}
 
         Structure your lecture with:
-        1. Introduction to {topic}
-        2. Key concepts and principles
-        3. Important theories and applications
-        4. Recent developments and future directions
-        5. Conclusion and key takeaways
+{outline}
         """
 
-        # Generate the lecture using Gemini
-        response = client.models.generate_content(
-            model="models/gemini-2.0-flash",  # Using the same model as chat for consistency
-            contents=template
-        )
+async def generate_lecture_section(topic: str, context: str, number: int, semaphore: asyncio.Semaphore) -> str:
+    """Generate one section of a lecture, off the event loop"""
+    prompt = lecture_template(topic, context) + f"""
+        Write only part {number}, "{section_title(topic, number)}", as a complete section of this lecture. The other parts are
+        written separately, so do not repeat their content and do not add an introduction or conclusion of your own.
+        """
+    async with semaphore:
+        with stage("gemini_section"):
+            response = await asyncio.to_thread(client.models.generate_content, model=GEMINI_MODEL, contents=prompt)
+    return response.text
+
+def open_lecture(topic: str, context: Optional[str]) -> LectureSections:
+    """Sections of the lecture on topic, cached or shared with a concurrent request when possible"""
+    semaphore = asyncio.Semaphore(max(1, LECTURE_SECTION_CONCURRENCY))
+    return LECTURES.open(
+        lecture_key(topic, context), lambda number: generate_lecture_section(topic, context, number, semaphore)
+    )
+
+async def stream_lecture_sections(topic: str, lecture: LectureSections):
+    """Yield the sections in outline order as they finish"""
+    try:
+        for number, section in enumerate(lecture.sections, 1):
+            try:
+                body = await section
+            except Exception as e:
+                logger.error("Error generating lecture section %d: %s", number, e)
+                body = f"Error generating section: {str(e)}"
+            yield format_section(topic, number, body)
+    finally:
+        # The client went away: stop waiting for the rest
+        lecture.close()
+
+async def lecture_context(topic: str, fallback: Optional[str]) -> Optional[str]:
+    """Knowledge base context for a lecture, or the context provided with the request"""
+    # Query the knowledge base for relevant information
+    with stage("kb_query"):
+        kb_results = await query_knowledge_base(topic)
 
-        # Get the response text
-        lecture_text = response.text
+    # Extract context from knowledge base results
+    kb_context = ""
+    if kb_results and "documents" in kb_results and kb_results["documents"]:
+        for doc in kb_results["documents"]:
+            kb_context += doc["content"] + "\n\n"
 
-        return lecture_text
-    except Exception as e:
-        print(f"Error generating lecture: {str(e)}")
-        return f"Error generating lecture: {str(e)}"
+    # If no context was found in knowledge base, use the provided context
+    return kb_context if kb_context else fallback
 
 @app.post("/generate-lecture", response_model=LectureResponse)
 async def generate_lecture_endpoint(request: LectureRequest):
     """Generate a lecture on a specific topic using knowledge from the knowledge base"""
+    start_deadline()
     try:
         # Get the topic
         topic = request.topic
-
-        # Query the knowledge base for relevant information
-        kb_results = await query_knowledge_base(topic)
-
-        # Extract context from knowledge base results
-        kb_context = ""
-        if kb_results and "documents" in kb_results and kb_results["documents"]:
-            for doc in kb_results["documents"]:
-                kb_context += doc["content"] + "\n\n"
-
-        # If no context was found in knowledge base, use the provided context
-        context = kb_context if kb_context else request.context
-
-        # Generate the lecture
-        lecture = generate_lecture(topic, context)
+        context = await lecture_context(topic, request.context)
+
+        # Reuse the lecture generated for the same topic and context
+        sections = open_lecture(topic, context)
+        try:
+            bodies = [await section for section in sections.sections]
+            lecture = format_lecture(topic, bodies)
+        except Exception as e:
+            logger.error("Error generating lecture: %s", e)
+            lecture = f"Error generating lecture: {str(e)}"
+        finally:
+            sections.close()
 
         # Return the response
         return LectureResponse(
             lecture=lecture,
-            topic=topic
+            topic=topic,
+            cached=sections.cached
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating lecture: {str(e)}")
+
+@app.post("/generate-lecture/stream")
+async def stream_lecture_endpoint(request: LectureRequest):
+    """Generate the sections of a lecture concurrently and stream them in order as plain text"""
+    start_deadline()
+    try:
+        topic = request.topic
+        context = await lecture_context(topic, request.context)
+
+        lecture = open_lecture(topic, context)
+        return StreamingResponse(
+            stream_lecture_sections(topic, lecture),
+            media_type="text/plain; charset=utf-8",
+            headers={"X-Lecture-Cache": lecture.outcome}
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating lecture: {str(e)}")
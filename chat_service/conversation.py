@@ -0,0 +1,215 @@
+"""Follow-up query rewriting and per-session retrieval reuse for the chat service.
+
+A follow-up like "and what about its drawbacks?" retrieves poorly on its own, so it is
+rewritten into a standalone query ("what about Rust's drawbacks?") from the subject of
+the session's last standalone question. The context retrieved for a session is cached,
+and a follow-up whose terms are all covered by that context is answered from it without
+retrieving again.
+"""
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from prometheus_client import Counter, Gauge
+
+# "heuristic" rewrites follow-ups locally, "model" asks Gemini (falling back to the
+# heuristic), "off" disables rewriting and context reuse
+QUERY_REWRITE_MODE = os.getenv("QUERY_REWRITE_MODE", "heuristic")
+
+# Upper bound of a Gemini rewrite in "model" mode, within the turn's deadline
+QUERY_REWRITE_TIMEOUT_SECONDS = float(os.getenv("QUERY_REWRITE_TIMEOUT_SECONDS", "3"))
+
+# Sessions whose retrieved context is kept, and for how long
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1000"))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "1800"))
+
+# Share of a follow-up's terms the cached context must contain to be reused
+CONTEXT_REUSE_MIN_COVERAGE = float(os.getenv("CONTEXT_REUSE_MIN_COVERAGE", "1.0"))
+
+# Longer messages are treated as new questions, as are messages with a pronoun that name
+# more than a few things of their own
+FOLLOW_UP_MAX_WORDS = 12
+FOLLOW_UP_MAX_TERMS = 3
+
+RETRIEVALS = Counter(
+    "chat_retrievals_total", "Chat turns by how their context was obtained", ["outcome"]
+)
+QUERY_REWRITES = Counter(
+    "chat_query_rewrites_total", "Follow-up questions rewritten into standalone queries", ["mode"]
+)
+
+CONNECTIVES = {"and", "also", "but", "so", "then", "or", "plus"}
+# Acknowledgements and greetings, which don't name a subject
+FILLERS = {
+    "bye", "cool", "got", "great", "hello", "hey", "hi", "nice", "no", "ok", "okay", "sure",
+    "thank", "thanks", "thx", "yeah", "yes"
+}
+PRONOUNS = {
+    "it", "its", "it's", "they", "them", "their", "theirs", "this", "that", "these", "those",
+    "he", "him", "his", "she", "her", "there"
+}
+STOPWORDS = {
+    "a", "about", "all", "an", "any", "are", "as", "at", "be", "been", "can", "compare",
+    "compared", "could", "describe", "did", "do", "does", "else", "every", "explain", "for",
+    "from", "give", "has", "have", "how", "i", "if", "in", "into", "is", "know", "like", "many",
+    "me", "more", "most", "much", "my", "of", "on", "other", "our", "please", "should", "some",
+    "tell", "than", "the", "there's", "to", "us", "versus", "vs", "was", "we", "were", "what",
+    "what's", "when", "where", "which", "who", "why", "will", "with", "would", "you", "your"
+} | CONNECTIVES | PRONOUNS | FILLERS
+
+_WORD = re.compile(r"[A-Za-z0-9][A-Za-z0-9'+#.-]*[A-Za-z0-9+#]|[A-Za-z0-9]")
+_LEADING_CONNECTIVE = re.compile(r"^\s*(?:and|also|but|so|then|or|plus)\b[\s,]*", re.IGNORECASE)
+_PRONOUN = re.compile(r"\b(its|their|it|they|them|this|that|these|those)\b", re.IGNORECASE)
+
+
+def _words(text: str) -> List[str]:
+    return _WORD.findall(text)
+
+
+def _stem(word: str) -> str:
+    """Crude normalization, so "drawbacks" matches "drawback" """
+    word = word.lower()
+    if word.endswith("'s"):
+        word = word[:-2]
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def content_terms(text: str) -> Set[str]:
+    """Normalized words of text that carry meaning"""
+    return {_stem(word) for word in _words(text) if word.lower() not in STOPWORDS}
+
+
+def _has_pronoun(message: str) -> bool:
+    return any(word.lower() in PRONOUNS for word in _words(message))
+
+
+def is_follow_up(message: str) -> bool:
+    """Whether a message only makes sense with the previous subject: it has no content
+    terms of its own ("why?"), or refers back with a pronoun ("and its drawbacks?").
+
+    A message that names its own subject ("what about Python?") stands on its own.
+    """
+    words = _words(message)
+    if not words or len(words) > FOLLOW_UP_MAX_WORDS:
+        return False
+    terms = content_terms(message)
+    return not terms or (_has_pronoun(message) and len(terms) <= FOLLOW_UP_MAX_TERMS)
+
+
+def subject(query: str) -> str:
+    """The meaningful words of a query, in order, e.g. "Rust" for "What is Rust?" """
+    return " ".join(word for word in _words(query) if word.lower() not in STOPWORDS)
+
+
+def rewrite_query(message: str, topic: str) -> str:
+    """Standalone version of a follow-up: its first pronoun is replaced by the previous subject,
+    which is prefixed to a message without content terms. Other messages are left as they are.
+    """
+    if not topic or not is_follow_up(message):
+        return message
+    cleaned = _LEADING_CONNECTIVE.sub("", message).strip() or message.strip()
+
+    def replace(match):
+        possessive = match.group(1).lower() in ("its", "their")
+        return f"{topic}'s" if possessive else topic
+
+    rewritten, count = _PRONOUN.subn(replace, cleaned, count=1)
+    if count:
+        return rewritten
+    if content_terms(message):
+        return message
+    return f"{topic} {cleaned}"
+
+
+def next_subject(message: str, previous: Optional[str]) -> Optional[str]:
+    """Subject of the conversation after message: its own, unless it is a follow-up or names
+    nothing (e.g. "thanks"), which keep the previous one"""
+    if is_follow_up(message):
+        return previous
+    return subject(message) or previous
+
+
+def previous_subject(messages: List[Dict[str, Any]], current: str) -> Optional[str]:
+    """Subject of the user's messages in a session's history, before the current one"""
+    user_messages = [msg["content"] for msg in messages if msg.get("role") == "user"]
+    if user_messages and user_messages[-1] == current:
+        user_messages = user_messages[:-1]
+    topic = None
+    for message in user_messages:
+        topic = next_subject(message, topic)
+    return topic
+
+
+class SessionContext:
+    """What was retrieved for a session, and the subject of its last standalone question"""
+
+    def __init__(self, subject: Optional[str], source: str, context: List[Dict[str, Any]]):
+        self.subject = subject
+        self.source = source
+        self.context = context
+        self.terms = content_terms(" ".join(_context_text(context)))
+        self.updated_at = time.monotonic()
+
+    def allowed(self, use_knowledge_base: bool, use_web_search: bool) -> bool:
+        """Whether the context came from a source the current turn may use"""
+        if self.source == "knowledge_base":
+            return use_knowledge_base
+        return self.source == "web_search" and use_web_search
+
+    def covers(self, message: str) -> bool:
+        """Whether the context mentions enough of the message's terms to answer it"""
+        terms = content_terms(message)
+        if not terms:
+            return True
+        covered = sum(1 for term in terms if term in self.terms)
+        return covered / len(terms) >= CONTEXT_REUSE_MIN_COVERAGE
+
+
+def _context_text(context: Iterable[Dict[str, Any]]) -> Iterable[str]:
+    for item in context:
+        for key in ("content", "title", "body"):
+            if item.get(key):
+                yield str(item[key])
+
+
+class SessionCache:
+    """Least-recently-used cache of retrieved context by chat id, with expiry"""
+
+    def __init__(self, max_sessions: int = SESSION_CACHE_SIZE, ttl_seconds: float = SESSION_CACHE_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions: "OrderedDict[str, SessionContext]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, chat_id: str) -> Optional[SessionContext]:
+        session = self._sessions.get(chat_id)
+        if session is None:
+            return None
+        if time.monotonic() - session.updated_at > self.ttl_seconds:
+            del self._sessions[chat_id]
+            return None
+        self._sessions.move_to_end(chat_id)
+        return session
+
+    def put(self, chat_id: str, session: SessionContext):
+        self._sessions[chat_id] = session
+        self._sessions.move_to_end(chat_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def discard(self, chat_id: str):
+        self._sessions.pop(chat_id, None)
+
+
+SESSIONS = SessionCache()
+
+SESSIONS_GAUGE = Gauge("chat_session_contexts", "Chat sessions with cached retrieval context")
+SESSIONS_GAUGE.set_function(lambda: len(SESSIONS))
@@ -0,0 +1,193 @@
+"""Lecture cache and the outline of section-by-section lecture generation.
+
+Lectures are cached by the normalized topic and a hash of the context they were
+generated from, so a repeated request is served instantly while a change in the
+knowledge base context produces a fresh lecture. The cache holds the bodies of the
+outline's sections, which each endpoint formats in its own way, and concurrent
+requests for a lecture that is being generated wait for that generation instead of
+starting their own.
+"""
+import asyncio
+import hashlib
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+# Lectures kept, least recently used first out, and for how long
+LECTURE_CACHE_SIZE = int(os.getenv("LECTURE_CACHE_SIZE", "100"))
+LECTURE_CACHE_TTL_SECONDS = float(os.getenv("LECTURE_CACHE_TTL_SECONDS", "86400"))
+
+# Sections of a lecture generated at the same time
+LECTURE_SECTION_CONCURRENCY = int(os.getenv("LECTURE_SECTION_CONCURRENCY", "5"))
+
+# The outline every lecture follows
+LECTURE_SECTIONS = [
+    "Introduction to {topic}",
+    "Key concepts and principles",
+    "Important theories and applications",
+    "Recent developments and future directions",
+    "Conclusion and key takeaways",
+]
+
+# "hit" is served from the cache, "shared" waits for a generation already under way
+LECTURE_CACHE_REQUESTS = Counter(
+    "lecture_cache_requests_total", "Lecture requests by cache outcome", ["outcome"]
+)
+
+LectureKey = Tuple[str, str]
+
+
+def normalize_topic(topic: str) -> str:
+    """Case-, spacing- and punctuation-insensitive form of a topic"""
+    normalized = unicodedata.normalize("NFKC", topic).casefold()
+    return " ".join(normalized.split()).strip(" .?!:;,")
+
+
+def lecture_key(topic: str, context: Optional[str]) -> Tuple[str, str]:
+    """Cache key of a lecture: normalized topic and hash of its context"""
+    context_hash = hashlib.sha256((context or "").encode("utf-8")).hexdigest()
+    return normalize_topic(topic), context_hash
+
+
+def section_title(topic: str, number: int) -> str:
+    return LECTURE_SECTIONS[number - 1].format(topic=topic)
+
+
+def format_section(topic: str, number: int, body: str) -> str:
+    """A section as streamed by /generate-lecture/stream, under its numbered heading"""
+    return f"## {number}. {section_title(topic, number)}\n\n{body.strip()}\n\n"
+
+
+def format_lecture(topic: str, bodies: List[str]) -> str:
+    """The whole lecture as returned by /generate-lecture, titled by its topic"""
+    sections = "".join(format_section(topic, number, body) for number, body in enumerate(bodies, 1))
+    return f"# {topic}\n\n{sections}".strip()
+
+
+class LectureGeneration:
+    """Sections of a lecture being generated, shared by every request waiting for it"""
+
+    def __init__(self, tasks: List["asyncio.Task[str]"]):
+        self.tasks = tasks
+        self.waiters = 0
+
+
+class LectureSections:
+    """One request's view of a lecture: its section bodies in outline order, as awaitables.
+
+    Awaiting a section never cancels it for the other requests sharing it; close() must be
+    called once the request is done with them.
+    """
+
+    def __init__(self, cache: "LectureCache", outcome: str, sections: List["asyncio.Future[str]"],
+                 generation: Optional[LectureGeneration] = None):
+        self.outcome = outcome
+        self.sections = sections
+        self._cache = cache
+        self._generation = generation
+
+    @property
+    def cached(self) -> bool:
+        return self.outcome == "hit"
+
+    def close(self):
+        for section in self.sections:
+            if not section.done():
+                section.cancel()
+            elif not section.cancelled():
+                # Mark failures as seen by this request
+                section.exception()
+        if self._generation is not None:
+            self._cache._release(self._generation)
+            self._generation = None
+
+
+class LectureCache:
+    """Least-recently-used cache of lecture section bodies with expiry"""
+
+    def __init__(self, max_entries: int = LECTURE_CACHE_SIZE, ttl_seconds: float = LECTURE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[LectureKey, Tuple[float, List[str]]]" = OrderedDict()
+        self._pending: Dict[LectureKey, LectureGeneration] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: LectureKey) -> Optional[List[str]]:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return list(entry[1])
+
+    def put(self, key: LectureKey, bodies: List[str]):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic(), list(bodies))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def open(self, key: LectureKey, generate: Callable[[int], Awaitable[str]]) -> LectureSections:
+        """The sections of the lecture for key, from the cache, from a generation already
+        under way, or from a new one that runs generate(number) for every section.
+
+        A new generation is cached once all its sections succeed, and cancelled when every
+        request waiting for it has closed its sections before it finished.
+        """
+        loop = asyncio.get_running_loop()
+        bodies = self.get(key)
+        if bodies is not None:
+            LECTURE_CACHE_REQUESTS.labels("hit").inc()
+            sections = []
+            for body in bodies:
+                section = loop.create_future()
+                section.set_result(body)
+                sections.append(section)
+            return LectureSections(self, "hit", sections)
+
+        generation = self._pending.get(key)
+        outcome = "shared"
+        if generation is None:
+            outcome = "miss"
+            generation = self._start(key, generate)
+        LECTURE_CACHE_REQUESTS.labels(outcome).inc()
+        generation.waiters += 1
+        return LectureSections(self, outcome, [asyncio.shield(task) for task in generation.tasks], generation)
+
+    def _start(self, key: LectureKey, generate: Callable[[int], Awaitable[str]]) -> LectureGeneration:
+        tasks = [
+            asyncio.ensure_future(generate(number)) for number in range(1, len(LECTURE_SECTIONS) + 1)
+        ]
+        generation = LectureGeneration(tasks)
+        self._pending[key] = generation
+
+        def finished(done: asyncio.Future):
+            if self._pending.get(key) is generation:
+                del self._pending[key]
+            # Only complete lectures are cached
+            if not done.cancelled() and done.exception() is None:
+                self.put(key, done.result())
+
+        asyncio.gather(*tasks).add_done_callback(finished)
+        return generation
+
+    def _release(self, generation: LectureGeneration):
+        generation.waiters -= 1
+        if generation.waiters <= 0:
+            for task in generation.tasks:
+                task.cancel()
+
+
+LECTURES = LectureCache()
+
+LECTURES_GAUGE = Gauge("lecture_cache_entries", "Lectures held in the lecture cache")
+LECTURES_GAUGE.set_function(lambda: len(LECTURES))
@@ -0,0 +1,218 @@
+"""Deadlines, circuit breakers and hedged requests for the chat service's downstream calls.
+
+Each request gets a deadline budget. Every downstream call is bounded by the smaller of
+its own timeout and what is left of the budget (minus a reserve kept for Gemini), and goes
+through a per-service circuit breaker, so a dead dependency is skipped immediately instead
+of costing a timeout on every turn.
+"""
+import asyncio
+import contextvars
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+from prometheus_client import Counter, Gauge
+
+# Total budget of a chat request, and the part of it kept for Gemini generation
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+GENERATION_RESERVE_SECONDS = float(os.getenv("GENERATION_RESERVE_SECONDS", "15"))
+
+# Upper bound of a single call to each downstream service
+DOWNSTREAM_TIMEOUTS = {
+    "knowledge_base": float(os.getenv("KNOWLEDGE_BASE_TIMEOUT_SECONDS", "5")),
+    "search": float(os.getenv("SEARCH_TIMEOUT_SECONDS", "8")),
+    "history": float(os.getenv("HISTORY_TIMEOUT_SECONDS", "2")),
+}
+
+# Circuit breaker settings
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+# Delay before a hedged knowledge base query is sent; 0 disables hedging
+KNOWLEDGE_BASE_HEDGE_DELAY_SECONDS = float(os.getenv("KNOWLEDGE_BASE_HEDGE_DELAY_SECONDS", "0"))
+
+DOWNSTREAM_REQUESTS = Counter(
+    "downstream_requests_total", "Calls to downstream services", ["target", "outcome"]
+)
+BREAKER_OPEN = Gauge(
+    "circuit_breaker_open", "Whether the circuit breaker of a downstream service is open", ["target"]
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a downstream service whose circuit breaker is open"""
+
+
+class DeadlineExceededError(Exception):
+    """Raised when no budget is left for a downstream call"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    Closed: calls go through. After ``failure_threshold`` consecutive failures it opens and
+    rejects calls for ``reset_seconds``; then one trial call is let through (half-open),
+    whose outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+        BREAKER_OPEN.labels(name).set(0)
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def release_trial(self, trial: bool = True):
+        """Give up a call's trial without an outcome, so the next call can be the trial"""
+        if trial:
+            self.trial_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        BREAKER_OPEN.labels(self.name).set(0)
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            BREAKER_OPEN.labels(self.name).set(1)
+
+
+BREAKERS: Dict[str, CircuitBreaker] = {name: CircuitBreaker(name) for name in DOWNSTREAM_TIMEOUTS}
+
+# Absolute deadline (time.monotonic()) of the current request
+_DEADLINE: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+
+def start_deadline(seconds: float = REQUEST_DEADLINE_SECONDS):
+    """Start the deadline budget of the current request"""
+    _DEADLINE.set(time.monotonic() + seconds)
+
+
+def remaining_budget() -> Optional[float]:
+    """Seconds left before the current request's deadline, or None without a deadline"""
+    deadline = _DEADLINE.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def call_timeout(target: str) -> float:
+    """Timeout of the next call to a downstream service under the current budget"""
+    timeout = DOWNSTREAM_TIMEOUTS[target]
+    remaining = remaining_budget()
+    if remaining is not None:
+        timeout = min(timeout, remaining - GENERATION_RESERVE_SECONDS)
+    if timeout <= 0:
+        raise DeadlineExceededError(f"No time budget left to call {target}")
+    return timeout
+
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Shared connection pool for all downstream calls"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def downstream_request(target: str, method: str, url: str, **kwargs) -> httpx.Response:
+    """Call a downstream service through its circuit breaker, bounded by the request deadline"""
+    breaker = BREAKERS[target]
+    if not breaker.allow():
+        DOWNSTREAM_REQUESTS.labels(target, "short_circuit").inc()
+        raise CircuitOpenError(f"Circuit breaker for {target} is open")
+    trial = breaker.state == "half_open"
+    try:
+        timeout = call_timeout(target)
+    except DeadlineExceededError:
+        # Running out of budget says nothing about the downstream's health
+        breaker.release_trial(trial)
+        DOWNSTREAM_REQUESTS.labels(target, "deadline").inc()
+        raise
+
+    try:
+        response = await get_client().request(method, url, timeout=timeout, **kwargs)
+    except httpx.TimeoutException:
+        breaker.record_failure()
+        DOWNSTREAM_REQUESTS.labels(target, "timeout").inc()
+        raise
+    except httpx.HTTPError:
+        breaker.record_failure()
+        DOWNSTREAM_REQUESTS.labels(target, "error").inc()
+        raise
+    except BaseException:
+        # Cancelled (client gone, hedge lost, outer timeout): no verdict on the downstream,
+        # but a trial must not keep the breaker from ever trying again
+        breaker.release_trial(trial)
+        raise
+
+    if response.status_code >= 500:
+        breaker.record_failure()
+        DOWNSTREAM_REQUESTS.labels(target, "error").inc()
+    else:
+        breaker.record_success()
+        DOWNSTREAM_REQUESTS.labels(target, "success").inc()
+    return response
+
+
+async def hedged(call: Callable[[], Awaitable[Any]], delay: float) -> Any:
+    """Run call, and if it hasn't finished after delay seconds, race it against a second attempt.
+
+    The first successful result wins and the other attempt is cancelled. A delay of 0
+    disables hedging.
+    """
+    first = asyncio.ensure_future(call())
+    if delay <= 0:
+        return await first
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+
+    pending = {first, asyncio.ensure_future(call())}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
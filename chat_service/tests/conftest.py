@@ -0,0 +1,20 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The service's modules, and the modules shared by all services
+sys.path.insert(0, os.path.join(os.path.dirname(SERVICE_DIR), "common"))
+sys.path.insert(0, SERVICE_DIR)
+
+
+@pytest.fixture(scope="session")
+def chat_app():
+    """The service's app module, loaded under its own name so it can't clash with other services'"""
+    spec = importlib.util.spec_from_file_location("chat_app", os.path.join(SERVICE_DIR, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import conversation
+from conversation import (
+    SessionCache, SessionContext, content_terms, is_follow_up, next_subject, previous_subject, rewrite_query
+)
+
+
+@pytest.mark.parametrize("message", [
+    "and what about its drawbacks?", "is it fast?", "why?", "How do they compare?", "and then?"
+])
+def test_follow_ups(message):
+    assert is_follow_up(message)
+
+
+@pytest.mark.parametrize("message", [
+    "what about Python?", "What is Rust?", "Explain garbage collection in Go",
+    "how does it compare to Python, Java, Go and C++ for systems programming?",
+    "Is it true that a very long message with a pronoun is still a question of its own?"
+])
+def test_standalone_questions(message):
+    assert not is_follow_up(message)
+
+
+def test_pronoun_is_replaced_by_subject():
+    assert rewrite_query("and what about its drawbacks?", "Rust") == "what about Rust's drawbacks?"
+    assert rewrite_query("is it fast?", "Rust") == "is Rust fast?"
+
+
+def test_message_without_content_terms_is_prefixed():
+    assert rewrite_query("why?", "Rust") == "Rust why?"
+
+
+def test_message_naming_its_own_subject_is_unchanged():
+    assert rewrite_query("what about Python?", "Rust") == "what about Python?"
+    assert rewrite_query("is it fast?", "") == "is it fast?"
+
+
+def test_acknowledgement_keeps_subject():
+    assert content_terms("thanks!") == set()
+    assert next_subject("thanks", "Rust") == "Rust"
+    assert next_subject("ok, thank you", "Rust") == "Rust"
+    assert rewrite_query("Tell me about it", next_subject("thanks", "Rust")) == "Tell me about Rust"
+
+
+def test_chained_follow_ups_do_not_compound():
+    topic = next_subject("What is Rust?", None)
+    queries = []
+    for message in ["and its drawbacks?", "and its performance?", "why?"]:
+        queries.append(rewrite_query(message, topic))
+        topic = next_subject(message, topic)
+    assert queries == ["Rust's drawbacks?", "Rust's performance?", "Rust why?"]
+    assert topic == "Rust"
+
+
+def test_new_question_changes_subject():
+    assert next_subject("what about Python?", "Rust") == "Python"
+
+
+def test_previous_subject_from_history():
+    messages = [
+        {"role": "user", "content": "What is Rust?"},
+        {"role": "assistant", "content": "Rust is a systems programming language."},
+        {"role": "user", "content": "and its drawbacks?"},
+        {"role": "user", "content": "thanks"},
+        {"role": "user", "content": "is it fast?"},
+    ]
+    assert previous_subject(messages, "is it fast?") == "Rust"
+    assert previous_subject(messages[:1], "What is Rust?") is None
+
+
+def test_context_covers_follow_up_terms():
+    session = SessionContext("Rust", "knowledge_base", [{"content": "Rust drawbacks include compile times."}])
+    assert session.covers("and its drawbacks?")
+    assert session.covers("why?")
+    assert not session.covers("and its ecosystem?")
+    assert session.allowed(use_knowledge_base=True, use_web_search=False)
+    assert not session.allowed(use_knowledge_base=False, use_web_search=True)
+
+
+def test_session_cache_evicts_least_recently_used():
+    cache = SessionCache(max_sessions=2, ttl_seconds=60)
+    for chat_id in ("a", "b"):
+        cache.put(chat_id, SessionContext("Rust", "web_search", []))
+    cache.get("a")
+    cache.put("c", SessionContext("Go", "web_search", []))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_session_cache_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(conversation.time, "monotonic", lambda: now[0])
+    cache = SessionCache(max_sessions=10, ttl_seconds=60)
+    cache.put("a", SessionContext("Rust", "web_search", []))
+    now[0] += 61
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+class SlowModels:
+    """Stands in for the Gemini client, blocking like a slow call"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.threads = []
+
+    def generate_content(self, model, contents):
+        self.threads.append(threading.current_thread())
+        time.sleep(self.delay)
+
+        class Response:
+            text = "Rust drawbacks"
+        return Response()
+
+
+@pytest.fixture
+def model_rewrites(chat_app, monkeypatch):
+    monkeypatch.setattr(chat_app, "QUERY_REWRITE_MODE", "model")
+    monkeypatch.setattr(chat_app, "client", type("Client", (), {})())
+    return chat_app
+
+
+def test_model_rewrite_runs_off_the_event_loop(model_rewrites):
+    models = SlowModels(0.05)
+    model_rewrites.client.models = models
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        rewritten = await model_rewrites.rewrite_follow_up("and its drawbacks?", "Rust", "")
+        ticker.cancel()
+        return rewritten, ticks
+
+    rewritten, ticks = asyncio.run(run())
+    assert rewritten == "Rust drawbacks"
+    assert models.threads[0] is not threading.main_thread()
+    assert ticks > 1
+
+
+def test_slow_model_rewrite_falls_back_to_heuristic(model_rewrites, monkeypatch):
+    model_rewrites.client.models = SlowModels(0.5)
+    monkeypatch.setattr(model_rewrites, "QUERY_REWRITE_TIMEOUT_SECONDS", 0.05)
+
+    async def run():
+        started = time.monotonic()
+        rewritten = await model_rewrites.rewrite_follow_up("and its drawbacks?", "Rust", "")
+        return rewritten, time.monotonic() - started
+
+    rewritten, elapsed = asyncio.run(run())
+    assert rewritten == "Rust's drawbacks?"
+    assert elapsed < 0.4
+
+
+def test_model_rewrite_is_skipped_without_budget(model_rewrites):
+    models = SlowModels(0)
+    model_rewrites.client.models = models
+
+    async def run():
+        # Less time left than the generation reserve
+        model_rewrites.start_deadline(model_rewrites.GENERATION_RESERVE_SECONDS / 2)
+        return await model_rewrites.rewrite_follow_up("why?", "Rust", "")
+
+    assert asyncio.run(run()) == "Rust why?"
+    assert models.threads == []
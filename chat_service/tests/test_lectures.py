@@ -0,0 +1,184 @@
+import asyncio
+
+import httpx
+import pytest
+
+import lectures
+from lectures import LECTURE_SECTIONS, LectureCache, format_lecture, format_section, lecture_key
+
+BODIES = [f"Body {number}" for number in range(1, len(LECTURE_SECTIONS) + 1)]
+
+
+class Generator:
+    """Section generator counting its calls, optionally held until released"""
+
+    def __init__(self, fail=None):
+        self.calls = []
+        self.cancelled = []
+        self.fail = fail
+        self.release = None
+
+    async def __call__(self, number):
+        self.calls.append(number)
+        try:
+            if self.release is not None:
+                await self.release.wait()
+            else:
+                await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            self.cancelled.append(number)
+            raise
+        if number == self.fail:
+            raise RuntimeError(f"section {number} failed")
+        return f"Body {number}"
+
+
+async def read(sections):
+    try:
+        return [await section for section in sections.sections]
+    finally:
+        sections.close()
+
+
+def test_lecture_key_ignores_case_spacing_and_punctuation():
+    assert lecture_key("Neural  Networks?", "ctx") == lecture_key("neural networks", "ctx")
+    assert lecture_key("Neural networks", "ctx") != lecture_key("Neural networks", "other ctx")
+    assert lecture_key("Neural networks", None) == lecture_key("Neural networks", "")
+
+
+def test_cache_evicts_least_recently_used():
+    cache = LectureCache(max_entries=2, ttl_seconds=60)
+    cache.put(("a", ""), BODIES)
+    cache.put(("b", ""), BODIES)
+    cache.get(("a", ""))
+    cache.put(("c", ""), BODIES)
+    assert cache.get(("b", "")) is None
+    assert cache.get(("a", "")) == BODIES and cache.get(("c", "")) == BODIES
+
+
+def test_cache_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(lectures.time, "monotonic", lambda: now[0])
+    cache = LectureCache(max_entries=10, ttl_seconds=60)
+    cache.put(("a", ""), BODIES)
+    now[0] += 61
+    assert cache.get(("a", "")) is None
+    assert len(cache) == 0
+
+
+def test_zero_size_disables_caching():
+    cache = LectureCache(max_entries=0)
+    cache.put(("a", ""), BODIES)
+    assert cache.get(("a", "")) is None
+
+
+def test_generated_lecture_is_cached_and_served_from_cache():
+    cache = LectureCache()
+    generate = Generator()
+
+    async def run():
+        first = cache.open(("a", ""), generate)
+        bodies = await read(first)
+        # The cache is filled once the generation's callbacks have run
+        await asyncio.sleep(0)
+        second = cache.open(("a", ""), generate)
+        return first.outcome, bodies, second.outcome, await read(second)
+
+    assert asyncio.run(run()) == ("miss", BODIES, "hit", BODIES)
+    assert generate.calls == [1, 2, 3, 4, 5]
+
+
+def test_concurrent_misses_share_one_generation():
+    cache = LectureCache()
+    generate = Generator()
+
+    async def run():
+        generate.release = asyncio.Event()
+        first = cache.open(("a", ""), generate)
+        second = cache.open(("a", ""), generate)
+        readers = [asyncio.ensure_future(read(first)), asyncio.ensure_future(read(second))]
+        await asyncio.sleep(0)
+        generate.release.set()
+        return [first.outcome, second.outcome], await asyncio.gather(*readers)
+
+    outcomes, results = asyncio.run(run())
+    assert outcomes == ["miss", "shared"]
+    assert results == [BODIES, BODIES]
+    assert generate.calls == [1, 2, 3, 4, 5]
+
+
+def test_generation_continues_while_a_request_still_waits():
+    cache = LectureCache()
+    generate = Generator()
+
+    async def run():
+        generate.release = asyncio.Event()
+        first = cache.open(("a", ""), generate)
+        second = cache.open(("a", ""), generate)
+        # The first request goes away before the lecture is done
+        leaver = asyncio.ensure_future(read(first))
+        await asyncio.sleep(0)
+        leaver.cancel()
+        await asyncio.sleep(0)
+        generate.release.set()
+        return await read(second)
+
+    assert asyncio.run(run()) == BODIES
+    assert generate.cancelled == []
+
+
+def test_generation_is_cancelled_when_every_request_leaves():
+    cache = LectureCache()
+    generate = Generator()
+
+    async def run():
+        generate.release = asyncio.Event()
+        sections = cache.open(("a", ""), generate)
+        await asyncio.sleep(0)
+        sections.close()
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert generate.cancelled == [1, 2, 3, 4, 5]
+    assert len(cache) == 0
+
+
+def test_failed_generation_is_not_cached():
+    cache = LectureCache()
+    generate = Generator(fail=3)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await read(cache.open(("a", ""), generate))
+        await asyncio.sleep(0)
+        return cache.open(("a", ""), generate).outcome
+
+    assert asyncio.run(run()) == "miss"
+
+
+def test_each_endpoint_formats_the_cached_sections(chat_app, monkeypatch):
+    monkeypatch.setattr(chat_app, "LECTURES", LectureCache())
+
+    async def no_context(topic):
+        return None
+
+    async def generate(topic, context, number, semaphore):
+        return f"Body {number}"
+
+    monkeypatch.setattr(chat_app, "query_knowledge_base", no_context)
+    monkeypatch.setattr(chat_app, "generate_lecture_section", generate)
+
+    async def run():
+        transport = httpx.ASGITransport(app=chat_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://chat") as client:
+            streamed = await client.post("/generate-lecture/stream", json={"topic": "Rust"})
+            await asyncio.sleep(0)
+            lecture = await client.post("/generate-lecture", json={"topic": "rust"})
+            return streamed, lecture
+
+    streamed, lecture = asyncio.run(run())
+    assert streamed.headers["X-Lecture-Cache"] == "miss"
+    assert streamed.text == "".join(format_section("Rust", n, body) for n, body in enumerate(BODIES, 1))
+    assert lecture.json()["cached"] is True
+    assert lecture.json()["lecture"] == format_lecture("rust", BODIES)
+    assert lecture.json()["lecture"].startswith("# rust\n\n## 1. Introduction to rust\n\nBody 1")
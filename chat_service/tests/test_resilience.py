@@ -0,0 +1,198 @@
+import asyncio
+
+import httpx
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, hedged
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(resilience.time, "monotonic", clock)
+    return clock
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_seconds=10)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_seconds=10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_lets_one_trial_through(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_seconds=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_trial_success_closes_breaker(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_seconds=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_trial_failure_reopens_breaker(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_seconds=10)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    # A single failed trial is enough to open it again, for a full reset period
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 9
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_downstream_request_short_circuits_open_breaker(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url)
+        return httpx.Response(503)
+
+    async def run():
+        monkeypatch.setattr(resilience, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        monkeypatch.setitem(resilience.BREAKERS, "search", CircuitBreaker("search", failure_threshold=2))
+        for _ in range(2):
+            response = await resilience.downstream_request("search", "GET", "http://search/")
+            assert response.status_code == 503
+        with pytest.raises(CircuitOpenError):
+            await resilience.downstream_request("search", "GET", "http://search/")
+        await resilience.close_client()
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_cancelled_trial_lets_the_next_call_try(clock, monkeypatch):
+    started = []
+
+    async def handler(request):
+        started.append(request.url)
+        if len(started) == 1:
+            await asyncio.sleep(10)
+        return httpx.Response(200)
+
+    async def run():
+        monkeypatch.setattr(resilience, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        breaker = CircuitBreaker("search", failure_threshold=1, reset_seconds=10)
+        monkeypatch.setitem(resilience.BREAKERS, "search", breaker)
+        breaker.record_failure()
+        clock.now += 10
+
+        trial = asyncio.ensure_future(resilience.downstream_request("search", "GET", "http://search/"))
+        await asyncio.sleep(0.01)
+        assert breaker.trial_in_flight
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        # The cancellation is neither a failure nor a stuck trial
+        assert breaker.state == "half_open" and not breaker.trial_in_flight
+
+        response = await resilience.downstream_request("search", "GET", "http://search/")
+        assert response.status_code == 200 and breaker.state == "closed"
+        await resilience.close_client()
+
+    asyncio.run(run())
+    assert len(started) == 2
+
+
+def test_hedged_without_delay_makes_one_call():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    assert asyncio.run(hedged(call, 0)) == "result"
+    assert len(calls) == 1
+
+
+def test_hedged_fast_call_is_not_hedged():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        return "result"
+
+    assert asyncio.run(hedged(call, 0.05)) == "result"
+    assert len(calls) == 1
+
+
+def test_hedged_slow_call_is_raced_and_loser_cancelled():
+    delays = [1.0, 0.0]
+    cancelled = []
+
+    async def call():
+        delay = delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return delay
+
+    async def run():
+        result = await hedged(call, 0.02)
+        # Let the cancellation of the slow attempt be delivered
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == 0.0
+    assert cancelled == [1.0]
+
+
+def test_hedged_returns_success_when_one_attempt_fails():
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) == 1:
+            await asyncio.sleep(0.05)
+            raise httpx.ConnectError("first attempt failed")
+        await asyncio.sleep(0.1)
+        return "second"
+
+    assert asyncio.run(hedged(call, 0.01)) == "second"
+
+
+def test_hedged_raises_when_every_attempt_fails():
+    async def call():
+        await asyncio.sleep(0.02)
+        raise httpx.ConnectError("down")
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(hedged(call, 0.01))
@@ -0,0 +1,154 @@
+"""Request metrics, per-stage timers and trace propagation for the AI Agent MVP services.
+
+Shared by all services: the Dockerfiles copy this directory into every image and put
+it on PYTHONPATH.
+
+Usage:
+    install(app, "chat_service")      # request metrics, /metrics and Server-Timing
+    with stage("kb_query"):           # time one stage of the current request
+        ...
+    headers = trace_headers()         # propagate the trace to a downstream call
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# OpenTelemetry is optional: without it stages are still timed, just not traced
+try:
+    from opentelemetry import propagate, trace
+except ImportError:
+    propagate = None
+    trace = None
+
+# Latency buckets in seconds, from fast in-process stages up to long Gemini generations
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests handled", ["service", "method", "route", "status"]
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["service", "method", "route"],
+    buckets=LATENCY_BUCKETS
+)
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests currently being handled", ["service"]
+)
+STAGE_LATENCY = Histogram(
+    "stage_duration_seconds", "Latency of an internal stage of a request", ["service", "stage"],
+    buckets=LATENCY_BUCKETS
+)
+
+# Name of the service this process runs, set by install()
+SERVICE_NAME = "unknown"
+
+# Stage timings of the current request, in seconds
+_STAGES: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("stages", default=None)
+
+_tracer = None
+
+
+def _configure_tracing(service: str):
+    """Set up an OpenTelemetry tracer, exporting over OTLP when an endpoint is configured"""
+    global _tracer
+    if trace is None:
+        return
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+
+        provider = TracerProvider(resource=Resource.create({"service.name": service}))
+        endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+        if endpoint:
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+        trace.set_tracer_provider(provider)
+    except ImportError:
+        # Only the API is installed: incoming trace context is still propagated
+        pass
+    _tracer = trace.get_tracer(service)
+
+
+def record_stage(name: str, seconds: float):
+    """Record the duration of a stage for the current request and in the stage histogram"""
+    STAGE_LATENCY.labels(SERVICE_NAME, name).observe(seconds)
+    stages = _STAGES.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    """Time a stage of the current request, as a child span when tracing is enabled"""
+    start = time.perf_counter()
+    try:
+        if _tracer is not None:
+            with _tracer.start_as_current_span(name):
+                yield
+        else:
+            yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def trace_headers() -> Dict[str, str]:
+    """Headers that carry the current trace context to a downstream service"""
+    headers: Dict[str, str] = {}
+    if propagate is not None:
+        propagate.inject(headers)
+    return headers
+
+
+def server_timing(stages: Dict[str, float]) -> str:
+    """Format stage timings as a Server-Timing header value"""
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in stages.items())
+
+
+def install(app: FastAPI, service: str):
+    """Add request metrics, Server-Timing headers, tracing and a /metrics endpoint to an app"""
+    global SERVICE_NAME
+    SERVICE_NAME = service
+    _configure_tracing(service)
+
+    @app.middleware("http")
+    async def instrument_request(request: Request, call_next):
+        stages: Dict[str, float] = {}
+        token = _STAGES.set(stages)
+        span = None
+        if _tracer is not None:
+            span = _tracer.start_as_current_span(
+                f"{request.method} {request.url.path}",
+                context=propagate.extract(request.headers),
+                kind=trace.SpanKind.SERVER,
+            )
+            span.__enter__()
+        IN_FLIGHT.labels(service).inc()
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            elapsed = time.perf_counter() - start
+            IN_FLIGHT.labels(service).dec()
+            # Label by route template so ids in paths don't explode the label set
+            route = request.scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            REQUESTS.labels(service, request.method, route_path, str(status)).inc()
+            REQUEST_LATENCY.labels(service, request.method, route_path).observe(elapsed)
+            if span is not None:
+                span.__exit__(None, None, None)
+            _STAGES.reset(token)
+        stages["total"] = elapsed
+        response.headers["Server-Timing"] = server_timing(stages)
+        return response
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        """Prometheus metrics"""
+        return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
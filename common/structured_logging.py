@@ -0,0 +1,172 @@
+"""Structured JSON logging with a non-blocking, queue-backed handler.
+
+Shared by all services: the Dockerfiles copy this directory into every image and put
+it on PYTHONPATH.
+
+Records are put on a bounded in-memory queue by the request path and formatted and
+written to stdout by a background thread, so logging never blocks a request on I/O.
+When the queue is full new records are dropped (and counted) rather than waited on.
+
+Usage:
+    logger = install_logging(app, "chat_service")
+    logger.info("Querying knowledge base", extra={"fields": {"n_results": 3}})
+    log_payload(logger, "Search results", results)   # sampled, truncated, DEBUG only
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict
+
+from fastapi import FastAPI, Request
+from prometheus_client import Counter
+
+# Logging configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Fraction of verbose payloads (search results, prompts, ...) that get logged at DEBUG
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+
+# Client libraries that log every call at INFO, kept at WARNING so a request doesn't
+# cost one log line per downstream call
+QUIET_LOGGERS = ("httpx",)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+DROPPED_RECORDS = Counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+
+# Request id of the current request, shared with downstream services
+_REQUEST_ID: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+_listener = None
+
+
+def get_request_id() -> str:
+    return _REQUEST_ID.get()
+
+
+def request_id_headers() -> Dict[str, str]:
+    """Headers that carry the current request id to a downstream service"""
+    request_id = _REQUEST_ID.get()
+    return {REQUEST_ID_HEADER: request_id} if request_id != "-" else {}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            text = json.dumps(payload, default=str)
+            if len(text) > LOG_PAYLOAD_MAX_CHARS:
+                text = text[:LOG_PAYLOAD_MAX_CHARS] + "...(truncated)"
+            entry["payload"] = text
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _RequestIdFilter(logging.Filter):
+    """Stamp records with the request id while still on the request's context"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _REQUEST_ID.get()
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only resolve the message and traceback here; JSON formatting happens on the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            DROPPED_RECORDS.inc()
+
+
+def log_payload(logger: logging.Logger, message: str, payload: Any, sample_rate: float = None):
+    """Log a large payload at DEBUG for a sample of calls; a no-op otherwise"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    rate = LOG_PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate < 1.0 and random.random() >= rate:
+        return
+    logger.debug(message, extra={"payload": payload})
+
+
+def configure_logging(service: str) -> logging.Logger:
+    """Route the root logger through the background queue and return the service logger"""
+    global _listener
+    if _listener is None:
+        log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonFormatter(service))
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        queue_handler = DroppingQueueHandler(log_queue)
+        queue_handler.addFilter(_RequestIdFilter())
+        root = logging.getLogger()
+        root.handlers = [queue_handler]
+        root.setLevel(LOG_LEVEL)
+        for name in QUIET_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+    return logging.getLogger(service)
+
+
+def install_logging(app: FastAPI, service: str) -> logging.Logger:
+    """Configure structured logging and tag every request with a request id"""
+    logger = configure_logging(service)
+
+    @app.middleware("http")
+    async def assign_request_id(request: Request, call_next):
+        request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        token = _REQUEST_ID.set(request_id)
+        try:
+            response = await call_next(request)
+        finally:
+            _REQUEST_ID.reset(token)
+        response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+
+    return logger
@@ -5,8 +5,11 @@ from typing import List, Optional
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
+from prometheus_client import Gauge
 from dotenv import load_dotenv
+from instrumentation import install, stage
+from structured_logging import install_logging
 
 # Load environment variables
 load_dotenv()
@@ -32,14 +35,61 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request metrics, Server-Timing headers, tracing and /metrics
+install(app, "history_service")
+
+# Structured JSON logging with request id correlation
+logger = install_logging(app, "history_service")
+
+# MongoDB connection pool gauges
+POOL_CONNECTIONS = Gauge("mongo_pool_connections", "Open connections in the MongoDB pool")
+POOL_CHECKED_OUT = Gauge("mongo_pool_checked_out", "MongoDB connections currently in use")
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Track the MongoDB connection pool in the pool gauges"""
+
+    def connection_created(self, event):
+        POOL_CONNECTIONS.inc()
+
+    def connection_closed(self, event):
+        POOL_CONNECTIONS.dec()
+
+    def connection_checked_out(self, event):
+        POOL_CHECKED_OUT.inc()
+
+    def connection_checked_in(self, event):
+        POOL_CHECKED_OUT.dec()
+
+    # Remaining pool events are not tracked
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
 # Connect to MongoDB
 try:
-    client = MongoClient(MONGO_URI)
+    client = MongoClient(MONGO_URI, event_listeners=[PoolMetrics()])
     db = client[DB_NAME]
     collection = db[COLLECTION_NAME]
-    print(f"Connected to MongoDB: {MONGO_URI}")
+    logger.info("Connected to MongoDB: %s", MONGO_URI)
 except Exception as e:
-    print(f"Error connecting to MongoDB: {str(e)}")
+    logger.error("Error connecting to MongoDB: %s", e)
     # Create a fallback in-memory storage
     chat_history_store = {}
 
@@ -68,7 +118,8 @@ async def root():
         "endpoints": {
             "/history": "Create a new chat session",
             "/history/{chat_id}": "Get chat history by ID",
-            "/history/{chat_id}/messages": "Add a message to chat history"
+            "/history/{chat_id}/messages": "Add a message to chat history",
+            "/metrics": "Prometheus metrics"
         }
     }
 
@@ -81,9 +132,10 @@ async def create_chat_session():
         
         # Store in MongoDB if available
         try:
-            collection.insert_one(chat_session.dict())
+            with stage("mongo_insert"):
+                collection.insert_one(chat_session.dict())
         except Exception as e:
-            print(f"Error storing in MongoDB: {str(e)}")
+            logger.warning("Error storing in MongoDB: %s", e)
             # Fallback to in-memory storage
             chat_history_store[chat_session.chat_id] = chat_session.dict()
         
@@ -97,11 +149,12 @@ async def get_chat_history(chat_id: str):
     try:
         # Try to get from MongoDB
         try:
-            result = collection.find_one({"chat_id": chat_id})
+            with stage("mongo_find"):
+                result = collection.find_one({"chat_id": chat_id})
             if result:
                 return ChatSession(**result)
         except Exception as e:
-            print(f"Error retrieving from MongoDB: {str(e)}")
+            logger.warning("Error retrieving from MongoDB: %s", e)
             # Fallback to in-memory storage
             if chat_id in chat_history_store:
                 return ChatSession(**chat_history_store[chat_id])
@@ -119,7 +172,8 @@ async def add_message(chat_id: str, message: AddMessageRequest):
     try:
         # Get the current chat session
         try:
-            chat_session_data = collection.find_one({"chat_id": chat_id})
+            with stage("mongo_find"):
+                chat_session_data = collection.find_one({"chat_id": chat_id})
             if not chat_session_data:
                 # Try in-memory storage
                 if chat_id in chat_history_store:
@@ -129,7 +183,7 @@ async def add_message(chat_id: str, message: AddMessageRequest):
                     chat_session = ChatSession(chat_id=chat_id)
                     chat_session_data = chat_session.dict()
         except Exception as e:
-            print(f"Error retrieving from MongoDB: {str(e)}")
+            logger.warning("Error retrieving from MongoDB: %s", e)
             # Fallback to in-memory storage or create new
             if chat_id in chat_history_store:
                 chat_session_data = chat_history_store[chat_id]
@@ -150,13 +204,14 @@ async def add_message(chat_id: str, message: AddMessageRequest):
         
         # Update the storage
         try:
-            collection.update_one(
-                {"chat_id": chat_id},
-                {"$set": chat_session.dict()},
-                upsert=True
-            )
+            with stage("mongo_update"):
+                collection.update_one(
+                    {"chat_id": chat_id},
+                    {"$set": chat_session.dict()},
+                    upsert=True
+                )
         except Exception as e:
-            print(f"Error updating MongoDB: {str(e)}")
+            logger.warning("Error updating MongoDB: %s", e)
             # Fallback to in-memory storage
             chat_history_store[chat_id] = chat_session.dict()
         
@@ -1,15 +1,25 @@
 import os
-import uuid
 import json
+import hashlib
+import threading
+import unicodedata
 import numpy as np
-from typing import List, Optional, Dict, Any
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from typing import List, Optional, Dict, Any, Callable
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from google import genai
 from dotenv import load_dotenv
+from prometheus_client import Gauge
 import PyPDF2
 import io
+import asyncio
+import time
+from fastapi.responses import JSONResponse
+from instrumentation import install, stage
+from structured_logging import install_logging
+from jobs import COMPLETED, FAILED, Job, JobQueue, QueueFullError
+from index_store import IndexStore
 
 # Load environment variables
 load_dotenv()
@@ -34,19 +44,141 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request metrics, Server-Timing headers, tracing and /metrics
+install(app, "knowledge_base_service")
+
+# Structured JSON logging with request id correlation
+logger = install_logging(app, "knowledge_base_service")
+
 # Simple in-memory document store
 DOCUMENTS = []
 DOCUMENT_PATH = "./data/documents.json"
+# Serializes changes to DOCUMENTS between requests and ingestion workers
+DOCUMENTS_LOCK = threading.Lock()
+
+# Background ingestion settings
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "./data/jobs.db")
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./data/uploads")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "100"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 86400)))
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "2000"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+
+# Shared index settings: "auto" makes the first process to start the writer, the others
+# serve queries from the on-disk index and forward their writes to it
+KB_ROLE = os.getenv("KB_ROLE", "auto")
+INDEX_DIR = os.getenv("INDEX_DIR", "./data/index")
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "0.5"))
+WRITE_WAIT_SECONDS = float(os.getenv("WRITE_WAIT_SECONDS", "30"))
+
+# Compressed vectors searched first ("none", "int8" or "pq"), and how many candidates per
+# result are re-ranked exactly. Quantization shrinks what a query scans, not query time: the
+# float32 matrix is still mapped for the re-rank, and an exact float32 scan is faster
+INDEX_QUANTIZATION = os.getenv("INDEX_QUANTIZATION", "none")
+PQ_SUBVECTORS = int(os.getenv("PQ_SUBVECTORS", "96"))
+INDEX_RERANK_FACTOR = int(os.getenv("INDEX_RERANK_FACTOR", "10"))
+
+INDEX_STORE = IndexStore(
+    INDEX_DIR,
+    reload_interval=INDEX_RELOAD_INTERVAL,
+    quantization=INDEX_QUANTIZATION,
+    pq_subvectors=PQ_SUBVECTORS
+)
+if KB_ROLE == "reader":
+    IS_WRITER = False
+else:
+    IS_WRITER = INDEX_STORE.acquire_writer()
+    if KB_ROLE == "writer" and not IS_WRITER:
+        raise RuntimeError(f"KB_ROLE is writer but another process holds the writer lock in {INDEX_DIR}")
+logger.info("Serving the knowledge base as %s", "writer" if IS_WRITER else "reader")
+
+# Origin of documents added through /ingest rather than synced from a source, so it is
+# reserved as a source id
+DIRECT_SOURCE = "direct"
+
+# Embeddings by document id as float32 arrays, kept out of DOCUMENTS since a list of
+# Python floats takes about eight times the memory
+EMBEDDINGS: Dict[str, Optional[np.ndarray]] = {}
+
+def embedding_array(embedding: Optional[List[float]]) -> Optional[np.ndarray]:
+    """Compact float32 copy of an embedding"""
+    return np.asarray(embedding, dtype=np.float32) if embedding else None
+
+def publish_documents():
+    """Publish DOCUMENTS as a new index generation; callers hold INDEX_STORE.write_lock()"""
+    INDEX_STORE.publish(DOCUMENTS, [EMBEDDINGS[doc["id"]] for doc in DOCUMENTS])
 
-# Load existing documents if available
-try:
-    if os.path.exists(DOCUMENT_PATH):
-        with open(DOCUMENT_PATH, 'r') as f:
-            DOCUMENTS = json.load(f)
-        print(f"Loaded {len(DOCUMENTS)} documents from {DOCUMENT_PATH}")
-except Exception as e:
-    print(f"Error loading documents: {str(e)}")
-    DOCUMENTS = []
+# Helper function to save documents to disk
+def save_documents():
+    """Save documents to disk and publish them as a new index generation"""
+    os.makedirs(os.path.dirname(DOCUMENT_PATH), exist_ok=True)
+    with INDEX_STORE.write_lock():
+        # Write to a temporary file and rename, so a crash never leaves a truncated file
+        tmp_path = DOCUMENT_PATH + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump([stored_document(doc) for doc in DOCUMENTS], f)
+        os.replace(tmp_path, DOCUMENT_PATH)
+        publish_documents()
+
+def stored_document(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """A document with its embedding, as kept in documents.json"""
+    embedding = EMBEDDINGS.get(doc["id"])
+    return {**doc, "embedding": embedding.tolist() if embedding is not None else None}
+
+def content_id(text: str) -> str:
+    """Content-addressed document id: SHA-256 of the normalized text"""
+    normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def document_sources(doc: Dict[str, Any]) -> List[str]:
+    """Origins of a document: the sources it was synced from and/or DIRECT_SOURCE"""
+    doc["metadata"] = doc.get("metadata") or {}
+    if not doc["metadata"].get("sources"):
+        # Documents stored before origins were tracked came in through /ingest
+        doc["metadata"]["sources"] = [DIRECT_SOURCE]
+    return doc["metadata"]["sources"]
+
+def add_source(doc: Dict[str, Any], source_id: str) -> bool:
+    """Record an origin of a document, returning whether it is new; callers hold DOCUMENTS_LOCK"""
+    sources = document_sources(doc)
+    if source_id in sources:
+        return False
+    sources.append(source_id)
+    return True
+
+def rekey_documents(documents: List[Dict[str, Any]]):
+    """Give documents stored before ids were content hashes their content id.
+
+    Documents with the same content are merged into one that keeps the origins of all of
+    them. Returns the documents and how many ids changed.
+    """
+    by_id: Dict[str, Dict[str, Any]] = {}
+    changed = 0
+    for doc in documents:
+        doc_id = content_id(doc["content"])
+        if doc["id"] != doc_id:
+            doc["id"] = doc_id
+            changed += 1
+        kept = by_id.setdefault(doc_id, doc)
+        if kept is not doc:
+            for source_id in document_sources(doc):
+                add_source(kept, source_id)
+            if kept.get("embedding") is None:
+                kept["embedding"] = doc.get("embedding")
+    return list(by_id.values()), changed
+
+# Documents by id, kept in step with DOCUMENTS
+DOCUMENT_INDEX: Dict[str, Dict[str, Any]] = {}
+
+# Size and generation of the index served by this process
+DOCUMENTS_GAUGE = Gauge("kb_documents", "Documents held in the knowledge base")
+DOCUMENTS_GAUGE.set_function(lambda: len(INDEX_STORE.snapshot))
+GENERATION_GAUGE = Gauge("kb_index_generation", "Generation of the index served by this process")
+GENERATION_GAUGE.set_function(lambda: INDEX_STORE.snapshot.generation)
+SEARCH_BYTES_GAUGE = Gauge("kb_index_search_bytes", "Bytes of vectors scanned by a query, after quantization")
+SEARCH_BYTES_GAUGE.set_function(lambda: INDEX_STORE.snapshot.search_bytes)
 
 # Models
 class Document(BaseModel):
@@ -78,7 +210,7 @@ def generate_embedding(text: str):
         )
         return result.embedding
     except Exception as e:
-        print(f"Error generating embedding: {str(e)}")
+        logger.warning("Error generating embedding: %s", e)
         # Fallback to a simple embedding if Gemini fails
         return [0.0] * 768
 
@@ -92,12 +224,53 @@ def cosine_similarity(a, b):
         return 0
     return dot_product / (norm_a * norm_b)
 
-# Helper function to save documents to disk
-def save_documents():
-    """Save documents to disk"""
-    os.makedirs(os.path.dirname(DOCUMENT_PATH), exist_ok=True)
-    with open(DOCUMENT_PATH, 'w') as f:
-        json.dump(DOCUMENTS, f)
+def add_documents(docs: List[Dict[str, Any]]):
+    """Add documents to the store; callers hold DOCUMENTS_LOCK"""
+    for doc in docs:
+        EMBEDDINGS[doc["id"]] = embedding_array(doc.get("embedding"))
+        doc = {key: value for key, value in doc.items() if key != "embedding"}
+        DOCUMENTS.append(doc)
+        DOCUMENT_INDEX[doc["id"]] = doc
+
+def remove_documents(doc_ids) -> int:
+    """Remove documents from the store; callers hold DOCUMENTS_LOCK"""
+    doc_ids = {doc_id for doc_id in doc_ids if doc_id in DOCUMENT_INDEX}
+    if doc_ids:
+        DOCUMENTS[:] = [doc for doc in DOCUMENTS if doc["id"] not in doc_ids]
+        for doc_id in doc_ids:
+            del DOCUMENT_INDEX[doc_id]
+            EMBEDDINGS.pop(doc_id, None)
+    return len(doc_ids)
+
+def load_documents():
+    """Load documents.json into the store and publish it: the writer's startup"""
+    documents, rekeyed = [], 0
+    try:
+        if os.path.exists(DOCUMENT_PATH):
+            with open(DOCUMENT_PATH, 'r') as f:
+                documents, rekeyed = rekey_documents(json.load(f))
+            logger.info("Loaded %d documents from %s", len(documents), DOCUMENT_PATH)
+    except Exception as e:
+        logger.error("Error loading documents: %s", e)
+        documents, rekeyed = [], 0
+
+    with DOCUMENTS_LOCK:
+        DOCUMENTS.clear()
+        DOCUMENT_INDEX.clear()
+        EMBEDDINGS.clear()
+        add_documents(documents)
+
+        # Publish what was loaded, so readers serve exactly the writer's documents
+        if rekeyed:
+            logger.info("Moved %d documents to content-hash ids", rekeyed)
+            save_documents()
+        else:
+            with INDEX_STORE.write_lock():
+                publish_documents()
+
+# Only the writer keeps the documents in memory
+if IS_WRITER:
+    load_documents()
 
 @app.get("/")
 async def root():
@@ -108,68 +281,127 @@ async def root():
             "/ingest": "Add documents to the knowledge base",
             "/query": "Query the knowledge base",
             "/documents": "List all documents in the knowledge base",
+            "/documents/{document_id}": "Delete a document from the knowledge base",
+            "/sources/{source_id}": "Re-ingest (PUT) or delete (DELETE) all chunks of a source document",
             "/upload": "Upload a document file to the knowledge base",
-            "/upload-pdf": "Upload a PDF file to the knowledge base"
+            "/upload-pdf": "Upload a PDF file to the knowledge base",
+            "/jobs/{job_id}": "Get the progress of an upload's ingestion job",
+            "/index/recall": "Recall and memory of the quantized index against exact search",
+            "/metrics": "Prometheus metrics"
         }
     }
 
+class WriteQueued(Exception):
+    """Raised when a write forwarded to the writer hasn't finished within WRITE_WAIT_SECONDS"""
+
+    def __init__(self, job_id: str):
+        super().__init__(f"Write queued as job {job_id}")
+        self.job_id = job_id
+
+@app.exception_handler(WriteQueued)
+async def write_queued_handler(request, exc: WriteQueued):
+    """Answer a write still waiting for the writer with its job id"""
+    return JSONResponse(
+        status_code=202,
+        content={"message": "Write queued", "job_id": exc.job_id, "status": "queued"}
+    )
+
+async def apply_write(kind: str, payload: Dict[str, Any]):
+    """Apply a change to the knowledge base: directly in the writer, through the job queue elsewhere"""
+    if IS_WRITER:
+        return WRITE_HANDLERS[kind](**payload)
+
+    try:
+        job_id = JOBS.submit(kind, None, "application/json", {}, json.dumps(payload).encode("utf-8"))
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    deadline = time.monotonic() + WRITE_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        job = JOBS.get(job_id)
+        if job["status"] == COMPLETED:
+            # The writer publishes before completing the job, so this process sees its own write
+            INDEX_STORE.current(force=True)
+            return job["result"]
+        if job["status"] == FAILED:
+            raise RuntimeError(job["error"])
+        await asyncio.sleep(0.05)
+    raise WriteQueued(job_id)
+
 @app.post("/ingest")
 async def ingest_document(document: DocumentInput):
     """Add a document to the knowledge base"""
     try:
-        # Generate a unique ID for the document
-        doc_id = str(uuid.uuid4())
-
-        # Generate embedding for the document
-        embedding = generate_embedding(document.content)
+        return await apply_write("ingest", {"content": document.content, "metadata": document.metadata})
+    except (HTTPException, WriteQueued):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error ingesting document: {str(e)}")
 
-        # Create a new document
-        new_doc = Document(
-            id=doc_id,
-            content=document.content,
-            metadata=document.metadata,
-            embedding=embedding
-        )
+def ingest_content(content: str, metadata: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Embed and store a document unless identical content is already stored"""
+    # Identical content maps to the same ID, so it is only stored and embedded once
+    doc_id = content_id(content)
+    with DOCUMENTS_LOCK:
+        if doc_id in DOCUMENT_INDEX:
+            return keep_ingested(doc_id)
+
+    # Generate embedding for the document
+    with stage("embed"):
+        embedding = generate_embedding(content)
+
+    # Create a new document
+    new_doc = Document(
+        id=doc_id,
+        content=content,
+        metadata={**(metadata or {}), "sources": [DIRECT_SOURCE]},
+        embedding=embedding
+    )
+
+    with DOCUMENTS_LOCK:
+        # A concurrent request may have added the same content meanwhile
+        if doc_id in DOCUMENT_INDEX:
+            return keep_ingested(doc_id)
 
         # Add the document to the in-memory store
-        DOCUMENTS.append(new_doc.dict())
+        add_documents([new_doc.dict()])
 
         # Save documents to disk
-        save_documents()
+        with stage("save_documents"):
+            save_documents()
 
-        return {"message": "Document added successfully", "id": doc_id}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error ingesting document: {str(e)}")
+    return {"message": "Document added successfully", "id": doc_id}
+
+def keep_ingested(doc_id: str) -> Dict[str, Any]:
+    """Record that stored content was also ingested directly, so deleting the source it
+    came from keeps it; callers hold DOCUMENTS_LOCK"""
+    if add_source(DOCUMENT_INDEX[doc_id], DIRECT_SOURCE):
+        with stage("save_documents"):
+            save_documents()
+    return {"message": "Document already exists", "id": doc_id}
 
 @app.post("/query", response_model=QueryResponse)
 async def query_knowledge_base(request: QueryRequest):
     """Query the knowledge base for relevant documents"""
     try:
-        if not DOCUMENTS:
+        # Newest published generation of the shared index
+        snapshot = INDEX_STORE.current()
+        if not len(snapshot):
             return QueryResponse(documents=[], distances=[])
 
         # Generate embedding for the query
-        query_embedding = generate_embedding(request.query)
+        with stage("embed"):
+            query_embedding = generate_embedding(request.query)
 
-        # Compute similarities
-        similarities = []
-        for doc in DOCUMENTS:
-            if doc.get("embedding"):
-                similarity = cosine_similarity(query_embedding, doc["embedding"])
-                similarities.append((doc, similarity))
-
-        # Sort by similarity (descending)
-        similarities.sort(key=lambda x: x[1], reverse=True)
-
-        # Get top N results
-        top_n = min(request.n_results, len(similarities))
-        results = similarities[:top_n]
+        # Top N by cosine similarity
+        with stage("rank"):
+            results = snapshot.search(query_embedding, request.n_results, rerank_factor=INDEX_RERANK_FACTOR)
 
         # Format the response
         documents = []
         distances = []
-        for doc, similarity in results:
-            documents.append(Document(**doc))
+        for i, similarity in results:
+            documents.append(Document(**snapshot.document(i)))
             distances.append(1.0 - similarity)  # Convert similarity to distance
 
         return QueryResponse(
@@ -179,38 +411,303 @@ async def query_knowledge_base(request: QueryRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error querying knowledge base: {str(e)}")
 
+@app.get("/index/recall")
+async def index_recall(n_results: int = Query(10, ge=1), samples: int = Query(100, ge=1)):
+    """Measure recall@n_results of the quantized index against exact search"""
+    try:
+        return INDEX_STORE.current().recall_report(n_results, samples, INDEX_RERANK_FACTOR)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error measuring index recall: {str(e)}")
+
 @app.get("/documents")
 async def list_documents():
     """List all documents in the knowledge base"""
     try:
-        return {"documents": DOCUMENTS}
+        snapshot = INDEX_STORE.current()
+        return {"documents": [snapshot.document(i) for i in range(len(snapshot))]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing documents: {str(e)}")
 
+@app.delete("/documents/{document_id}")
+async def delete_document(document_id: str):
+    """Delete a document from the knowledge base"""
+    try:
+        result = await apply_write("delete_document", {"document_id": document_id})
+        if not result["removed"]:
+            raise HTTPException(status_code=404, detail=f"Document with ID {document_id} not found")
+        return {"message": "Document deleted successfully", "id": document_id}
+    except (HTTPException, WriteQueued):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error deleting document: {str(e)}")
+
+def remove_document(document_id: str) -> Dict[str, Any]:
+    """Delete a single document by ID"""
+    with DOCUMENTS_LOCK:
+        removed = remove_documents([document_id])
+        if removed:
+            save_documents()
+    return {"removed": removed}
+
+@app.put("/sources/{source_id}")
+async def update_source(source_id: str, document: DocumentInput):
+    """Ingest a new version of a source document, re-embedding only the chunks that changed"""
+    try:
+        check_source_id(source_id)
+        chunks = chunk_text(document.content)
+        if not chunks:
+            raise HTTPException(status_code=400, detail="Document content is empty")
+        return await apply_write(
+            "sync_source", {"source_id": source_id, "chunks": chunks, "metadata": document.metadata or {}}
+        )
+    except (HTTPException, WriteQueued):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error updating source: {str(e)}")
+
+@app.delete("/sources/{source_id}")
+async def delete_source(source_id: str):
+    """Delete all chunks of a source document that no other source shares"""
+    try:
+        check_source_id(source_id)
+        result = await apply_write("delete_source", {"source_id": source_id})
+        if result is None:
+            raise HTTPException(status_code=404, detail=f"Source with ID {source_id} not found")
+        return {"message": "Source deleted successfully", "source_id": source_id, "removed": result["removed"]}
+    except (HTTPException, WriteQueued):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error deleting source: {str(e)}")
+
+def remove_source(source_id: str) -> Optional[Dict[str, Any]]:
+    """Detach a source from its chunks, or None if no document references it"""
+    if not any(source_id in ((doc.get("metadata") or {}).get("sources") or []) for doc in DOCUMENTS):
+        return None
+    return sync_source(source_id, [], {})
+
+def check_source_id(source_id: Optional[str]):
+    """Reject the source id reserved for documents added through /ingest"""
+    if source_id == DIRECT_SOURCE:
+        raise HTTPException(
+            status_code=400, detail=f"Source ID {DIRECT_SOURCE!r} is reserved for documents added through /ingest"
+        )
+
+def parse_metadata(metadata: str) -> Dict[str, Any]:
+    """Parse the JSON metadata form field of an upload"""
+    try:
+        parsed = json.loads(metadata) if metadata else {}
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Metadata must be a JSON object: {str(e)}")
+    if not isinstance(parsed, dict):
+        raise HTTPException(status_code=400, detail="Metadata must be a JSON object")
+    check_source_id(parsed.get("source_id"))
+    return parsed
+
+def extract_text(job: Job):
+    """Extract the text of an uploaded file, with metadata describing the file"""
+    content = job.read_payload()
+    if job.kind == "pdf":
+        pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
+        text_content = ""
+
+        # Extract text from each page
+        for page_num in range(len(pdf_reader.pages)):
+            page = pdf_reader.pages[page_num]
+            text_content += page.extract_text() + "\n\n"
+        return text_content, {"content_type": "application/pdf", "page_count": len(pdf_reader.pages)}
+    return content.decode("utf-8"), {"content_type": job.content_type}
+
+def split_long_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Split text into overlapping chunks of about chunk_size characters, on whitespace"""
+    text = text.strip()
+    if len(text) <= chunk_size:
+        return [text] if text else []
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            # Break at the last whitespace in the window rather than mid-word
+            split = text.rfind(" ", start + chunk_size // 2, end)
+            if split != -1:
+                end = split
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+        # Start the overlap on a word boundary too
+        space = text.find(" ", start, end)
+        if space != -1:
+            start = space + 1
+    return [chunk for chunk in chunks if chunk]
+
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE) -> List[str]:
+    """Split text into chunks of about chunk_size characters along paragraph boundaries.
+
+    Whole paragraphs are packed together, so editing a paragraph only changes the chunk
+    it falls in (and at most shifts its neighbours), which keeps re-ingestion incremental.
+    Paragraphs longer than chunk_size are split into overlapping windows.
+    """
+    chunks = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) > chunk_size:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.extend(split_long_text(paragraph, chunk_size))
+        elif current and len(current) + 2 + len(paragraph) > chunk_size:
+            chunks.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+def sync_source(source_id: str, chunks: List[str], metadata: Dict[str, Any],
+                report: Optional[Callable[[float], None]] = None) -> Dict[str, Any]:
+    """Make the chunks of a source document match chunks, embedding only new content.
+
+    Chunks are content-addressed: a chunk already in the knowledge base (from this or any
+    other source, or ingested directly) is reused without a new embedding call. Chunks the
+    source no longer contains are detached from it, and deleted once they have no origin left.
+    """
+    # Content ids in document order, without repeats
+    chunk_ids = {}
+    for chunk in chunks:
+        chunk_ids.setdefault(content_id(chunk), chunk)
+
+    missing = [(doc_id, chunk) for doc_id, chunk in chunk_ids.items() if doc_id not in DOCUMENT_INDEX]
+    new_docs = []
+    for i, (doc_id, chunk) in enumerate(missing):
+        with stage("embed"):
+            embedding = generate_embedding(chunk)
+        new_docs.append(Document(
+            id=doc_id,
+            content=chunk,
+            metadata={**metadata, "source_id": source_id, "sources": [source_id]},
+            embedding=embedding
+        ).dict())
+        if report:
+            report((i + 1) / len(missing))
+
+    with DOCUMENTS_LOCK:
+        # Skip chunks a concurrent ingestion added meanwhile
+        add_documents([doc for doc in new_docs if doc["id"] not in DOCUMENT_INDEX])
+
+        for doc_id in chunk_ids:
+            add_source(DOCUMENT_INDEX[doc_id], source_id)
+
+        # Documents ingested directly keep DIRECT_SOURCE, so only those whose every origin
+        # was a synced source can end up without one
+        stale = []
+        for doc in DOCUMENTS:
+            sources = (doc.get("metadata") or {}).get("sources") or []
+            if source_id in sources and doc["id"] not in chunk_ids:
+                sources.remove(source_id)
+                if not sources:
+                    stale.append(doc["id"])
+        removed = remove_documents(stale)
+
+        with stage("save_documents"):
+            save_documents()
+
+    return {
+        "source_id": source_id,
+        "document_ids": list(chunk_ids),
+        "chunk_count": len(chunk_ids),
+        "added": len(new_docs),
+        "unchanged": len(chunk_ids) - len(new_docs),
+        "removed": removed
+    }
+
+def process_upload(job: Job) -> Dict[str, Any]:
+    """Ingestion pipeline of an upload job: extract, chunk, embed and index"""
+    job.report("extracting", 0.05)
+    with stage("job_extract"):
+        text, file_metadata = extract_text(job)
+
+    job.report("chunking", 0.1)
+    chunks = chunk_text(text)
+    if not chunks:
+        raise ValueError("No text could be extracted from the file")
+
+    # An upload replaces the previous version of a source only when it names the source;
+    # otherwise it is new content, under a source of its own. Embedding dominates the job,
+    # so it gets most of the progress range
+    source_id = str(job.metadata.get("source_id") or f"upload:{job.id}")
+    metadata = {"filename": job.filename, **file_metadata, **job.metadata, "job_id": job.id}
+    job.report("embedding", 0.1)
+    return sync_source(
+        source_id, chunks, metadata,
+        report=lambda fraction: job.report("embedding", 0.1 + 0.8 * fraction)
+    )
+
+# Changes readers forward to the writer through the job queue
+WRITE_HANDLERS: Dict[str, Callable[..., Any]] = {
+    "ingest": ingest_content,
+    "sync_source": sync_source,
+    "delete_source": remove_source,
+    "delete_document": remove_document,
+}
+
+def run_job(job: Job) -> Any:
+    """Run a queued job: an upload to ingest, or a write forwarded by a reader"""
+    if job.kind in WRITE_HANDLERS:
+        return WRITE_HANDLERS[job.kind](**json.loads(job.read_payload()))
+    return process_upload(job)
+
+# Background queue for uploads and forwarded writes, shared by all processes
+JOBS = JobQueue(
+    db_path=JOBS_DB_PATH,
+    upload_dir=UPLOAD_DIR,
+    handler=run_job,
+    workers=INGEST_WORKERS,
+    max_pending=INGEST_MAX_PENDING,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    retention_seconds=JOB_RETENTION_SECONDS
+)
+
+# Uploads waiting for or being processed by a worker
+PENDING_JOBS_GAUGE = Gauge("kb_ingest_jobs_pending", "Ingestion jobs queued or running")
+PENDING_JOBS_GAUGE.set_function(JOBS.pending)
+
+@app.on_event("startup")
+async def start_ingestion_workers():
+    """Start the ingestion workers in the writer, resuming jobs interrupted by a restart"""
+    if IS_WRITER:
+        JOBS.start()
+
+@app.on_event("shutdown")
+async def stop_ingestion_workers():
+    """Stop the ingestion workers"""
+    JOBS.stop()
+
+def submit_upload(kind: str, filename: str, content_type: str, metadata: Dict[str, Any], content: bytes):
+    """Queue an uploaded file for ingestion and describe the new job"""
+    try:
+        job_id = JOBS.submit(kind, filename, content_type, metadata, content)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"message": "Upload queued for ingestion", "job_id": job_id, "status": "queued"}
+
 @app.post("/upload")
 async def upload_document(
     file: UploadFile = File(...),
     metadata: str = Form("{}")
 ):
-    """Upload a document file to the knowledge base"""
+    """Upload a document file to the knowledge base; it is ingested in the background"""
     try:
         # Read the file content
         content = await file.read()
-        content_text = content.decode("utf-8")
-
-        # Create document with metadata
-        document = DocumentInput(
-            content=content_text,
-            metadata={
-                "filename": file.filename,
-                "content_type": file.content_type,
-                **eval(metadata)  # Convert string to dict (careful with security!)
-            }
-        )
-
-        # Ingest the document
-        result = await ingest_document(document)
-        return result
+        return submit_upload("text", file.filename, file.content_type, parse_metadata(metadata), content)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error uploading document: {str(e)}")
 
@@ -219,7 +716,7 @@ async def upload_pdf(
     file: UploadFile = File(...),
     metadata: str = Form("{}")
 ):
-    """Upload a PDF file to the knowledge base"""
+    """Upload a PDF file to the knowledge base; it is ingested in the background"""
     try:
         # Check if file is a PDF
         if not file.filename.lower().endswith('.pdf'):
@@ -227,35 +724,20 @@ async def upload_pdf(
 
         # Read the file content
         content = await file.read()
-
-        # Parse PDF content
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-        text_content = ""
-
-        # Extract text from each page
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            text_content += page.extract_text() + "\n\n"
-
-        # Create document with metadata
-        document = DocumentInput(
-            content=text_content,
-            metadata={
-                "filename": file.filename,
-                "content_type": "application/pdf",
-                "page_count": len(pdf_reader.pages),
-                **eval(metadata)  # Convert string to dict (careful with security!)
-            }
-        )
-
-        # Ingest the document
-        result = await ingest_document(document)
-        return result
+        return submit_upload("pdf", file.filename, "application/pdf", parse_metadata(metadata), content)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error uploading PDF: {str(e)}")
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get the status and progress of an ingestion job"""
+    job = JOBS.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job with ID {job_id} not found")
+    return job
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("app:app", host="0.0.0.0", port=8001, reload=True)
@@ -0,0 +1,430 @@
+"""Shared on-disk search index for serving the knowledge base from several processes.
+
+The writer process publishes the documents as numbered generations:
+
+    <index_dir>/generation              current generation number
+    <index_dir>/gen-00000042/
+        embeddings.npy                  float32 matrix, one row per document
+        norms.npy                       row norms, for cosine similarity
+        valid.npy                       rows that have an embedding
+        codes.npy, quantizer.npz        compressed vectors (see quantization.py), if enabled
+        documents.json                  ids, content and metadata (no embeddings)
+
+A generation directory is complete before the generation file is atomically replaced,
+so readers never see a partial index. Readers memory-map the embeddings, so every
+process on a host shares one copy through the page cache, and switch to a newer
+generation when the counter changes.
+
+With quantization, queries scan the compact codes and only the rows of a shortlist are
+read from the float32 matrix for an exact re-rank, so the working set of a search is
+the codes rather than the full vectors. The product quantizer's codebook is trained on
+a background thread; until it is ready, generations are published without codes and
+searched exactly.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from quantization import QUANTIZATIONS, ProductQuantizer, load_quantizer, train_quantizer
+
+# File locks are POSIX-only; without them a single process is always the writer
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger("knowledge_base_service.index")
+
+# Generations kept on disk, so readers still loading an older one don't lose it
+KEEP_GENERATIONS = 3
+
+# The product quantizer is retrained once the index has grown by this factor since training
+PQ_RETRAIN_GROWTH = 2.0
+
+
+class IndexSnapshot:
+    """One published generation of the index, ready to be searched"""
+
+    def __init__(self, generation: int, documents: List[Dict[str, Any]], matrix: np.ndarray,
+                 norms: np.ndarray, valid: np.ndarray, quantizer=None, codes: Optional[np.ndarray] = None):
+        self.generation = generation
+        self.documents = documents
+        self.matrix = matrix
+        self.norms = norms
+        self.valid = valid
+        self.valid_count = int(valid.sum())
+        self.quantizer = quantizer
+        self.codes = codes
+
+    @classmethod
+    def empty(cls) -> "IndexSnapshot":
+        return cls(0, [], np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.float32),
+                   np.zeros(0, dtype=bool))
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @property
+    def quantization(self) -> str:
+        return self.quantizer.kind if self.quantizer is not None else "none"
+
+    @property
+    def search_bytes(self) -> int:
+        """Size of what a query scans: the codes and quantizer, or the float32 matrix"""
+        if self.quantizer is None:
+            return int(self.matrix.nbytes)
+        return int(self.codes.nbytes + self.quantizer.nbytes)
+
+    def document(self, i: int) -> Dict[str, Any]:
+        """Document i with its embedding, in the shape stored in DOCUMENTS"""
+        embedding = self.matrix[i].tolist() if self.valid[i] else None
+        return {**self.documents[i], "embedding": embedding}
+
+    def _query_vector(self, query_embedding: Sequence[float]) -> np.ndarray:
+        # Queries of another dimension are truncated or zero-padded to the index's
+        query = np.zeros(self.matrix.shape[1], dtype=np.float32)
+        values = np.asarray(query_embedding, dtype=np.float32)[:len(query)]
+        query[:len(values)] = values
+        return query
+
+    def _cosine(self, rows: Optional[np.ndarray], query: np.ndarray) -> np.ndarray:
+        """Exact cosine similarity of the query with the given rows (all rows if None)"""
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        norms = self.norms if rows is None else self.norms[rows]
+        scores = matrix @ query
+        denominator = norms * np.linalg.norm(query)
+        similarities = np.divide(scores, denominator, out=np.zeros_like(scores), where=denominator > 0)
+        valid = self.valid if rows is None else self.valid[rows]
+        similarities[~valid] = -np.inf
+        return similarities
+
+    def search(self, query_embedding: Sequence[float], n_results: int, rerank_factor: int = 10,
+               exact: bool = False) -> List[Tuple[int, float]]:
+        """Indices and cosine similarities of the n_results most similar documents.
+
+        With a quantizer, the codes select n_results * rerank_factor candidates, which are
+        re-ranked exactly; a rerank_factor of 0 returns the approximate scores as they are.
+        """
+        count = min(n_results, self.valid_count)
+        if count <= 0:
+            return []
+        query = self._query_vector(query_embedding)
+        if exact or self.quantizer is None:
+            similarities = self._cosine(None, query)
+            return [(int(i), float(similarities[i])) for i in _top(similarities, count)]
+
+        norm = np.linalg.norm(query)
+        approximate = self.quantizer.scores(self.codes, query / norm if norm > 0 else query)
+        approximate[~self.valid] = -np.inf
+        if rerank_factor <= 0:
+            return [(int(i), float(approximate[i])) for i in _top(approximate, count)]
+
+        # Sorted rows read the memory-mapped matrix in file order
+        shortlist = np.sort(_top(approximate, min(self.valid_count, count * rerank_factor)))
+        similarities = self._cosine(shortlist, query)
+        return [(int(shortlist[i]), float(similarities[i])) for i in _top(similarities, count)]
+
+    def recall_report(self, n_results: int = 10, samples: int = 100, rerank_factor: int = 10,
+                      seed: int = 0) -> Dict[str, Any]:
+        """Recall@n_results and latency of quantized search against exact search.
+
+        Queries are perturbed copies of randomly chosen document embeddings.
+        """
+        report = {
+            "generation": self.generation,
+            "documents": len(self.documents),
+            "quantization": self.quantization,
+            "dim": int(self.matrix.shape[1]),
+            "n_results": n_results,
+            "rerank_factor": rerank_factor,
+            "float32_bytes": int(self.matrix.nbytes),
+            "search_bytes": self.search_bytes,
+        }
+        report["compression"] = report["float32_bytes"] / max(1, report["search_bytes"])
+
+        rows = np.flatnonzero(self.valid)
+        if not len(rows):
+            return {**report, "samples": 0}
+        rng = np.random.default_rng(seed)
+        picked = rng.choice(rows, min(samples, len(rows)), replace=False)
+        queries = []
+        for row in picked:
+            vector = np.asarray(self.matrix[row], dtype=np.float32) / max(float(self.norms[row]), 1e-12)
+            noise = rng.standard_normal(len(vector)).astype(np.float32)
+            queries.append(vector + 0.5 * noise / np.linalg.norm(noise))
+
+        def run(**kwargs):
+            results, start = [], time.perf_counter()
+            for query in queries:
+                results.append({i for i, _ in self.search(query, n_results, **kwargs)})
+            return results, (time.perf_counter() - start) * 1000 / len(queries)
+
+        expected, exact_ms = run(exact=True)
+        reranked, reranked_ms = run(rerank_factor=rerank_factor)
+        approximate, approximate_ms = run(rerank_factor=0)
+
+        def recall(found):
+            return float(np.mean([len(f & e) / max(1, len(e)) for f, e in zip(found, expected)]))
+
+        return {
+            **report,
+            "samples": len(queries),
+            "recall": recall(reranked),
+            "recall_without_rerank": recall(approximate),
+            "exact_ms": exact_ms,
+            "quantized_ms": reranked_ms,
+            "quantized_without_rerank_ms": approximate_ms,
+        }
+
+
+def _top(scores: np.ndarray, count: int) -> np.ndarray:
+    """Indices of the count highest scores, highest first (ties in index order)"""
+    top = np.argpartition(-scores, count - 1)[:count]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class IndexStore:
+    """Publishes and loads index generations in a directory shared by all processes"""
+
+    def __init__(self, index_dir: str, reload_interval: float = 0.5, quantization: str = "none",
+                 pq_subvectors: int = 96):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization!r}; expected one of {', '.join(QUANTIZATIONS)}")
+        self.index_dir = index_dir
+        self.reload_interval = reload_interval
+        self.quantization = quantization
+        self.pq_subvectors = pq_subvectors
+        # Product quantizer of the writer, the number of vectors it was trained on, and the
+        # thread training its successor
+        self._pq: Optional[ProductQuantizer] = None
+        self._pq_rows = 0
+        self._pq_loaded = False
+        self._training: Optional[threading.Thread] = None
+        self._generation_path = os.path.join(index_dir, "generation")
+        self.snapshot = IndexSnapshot.empty()
+        self._writer_lock_file = None
+        self._last_check = 0.0
+        self._reload_lock = threading.Lock()
+        # Stands in for the file lock between the threads of this process without fcntl
+        self._thread_write_lock = threading.Lock()
+        os.makedirs(index_dir, exist_ok=True)
+
+    def acquire_writer(self) -> bool:
+        """Try to become the single writer; the role is held until the process exits"""
+        if fcntl is None:
+            return True
+        lock_file = open(os.path.join(self.index_dir, "writer.lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._writer_lock_file = lock_file
+        return True
+
+    @contextmanager
+    def write_lock(self):
+        """Exclusive lock for changing the files of the knowledge base"""
+        if fcntl is None:
+            with self._thread_write_lock:
+                yield
+            return
+        with open(os.path.join(self.index_dir, "write.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def current_generation(self) -> int:
+        try:
+            with open(self._generation_path, "r") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _generation_dir(self, generation: int) -> str:
+        return os.path.join(self.index_dir, f"gen-{generation:08d}")
+
+    def publish(self, documents: List[Dict[str, Any]], embeddings: List[Optional[Sequence[float]]]) -> int:
+        """Write documents and their embeddings as a new generation and serve it; callers hold write_lock()"""
+        generation = self.current_generation() + 1
+        final_dir = self._generation_dir(generation)
+        tmp_dir = final_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        # Rows whose embedding doesn't have the common dimension are left out of search
+        dim = next((len(embedding) for embedding in embeddings if embedding is not None and len(embedding)), 0)
+        matrix = np.zeros((len(documents), dim), dtype=np.float32)
+        valid = np.zeros(len(documents), dtype=bool)
+        for i, embedding in enumerate(embeddings):
+            if embedding is not None and len(embedding) and len(embedding) == dim:
+                matrix[i] = embedding
+                valid[i] = True
+        norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+        np.save(os.path.join(tmp_dir, "embeddings.npy"), matrix)
+        np.save(os.path.join(tmp_dir, "norms.npy"), norms)
+        np.save(os.path.join(tmp_dir, "valid.npy"), valid)
+
+        unit = np.divide(matrix, norms[:, None], out=np.zeros_like(matrix), where=norms[:, None] > 0)
+        quantizer = self._train(unit[valid], generation)
+        if quantizer is not None:
+            codes = self._encode(quantizer, unit, documents, valid)
+            np.save(os.path.join(tmp_dir, "codes.npy"), codes)
+            quantizer.save(os.path.join(tmp_dir, "quantizer.npz"))
+        del unit
+        with open(os.path.join(tmp_dir, "documents.json"), "w") as f:
+            json.dump([{key: value for key, value in doc.items() if key != "embedding"} for doc in documents], f)
+
+        os.rename(tmp_dir, final_dir)
+        tmp_path = self._generation_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(generation))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._generation_path)
+        self._collect_garbage(generation)
+        self._activate(self.load(generation))
+        return generation
+
+    def _train(self, vectors: np.ndarray, generation: int):
+        """Quantizer for a new generation.
+
+        The product quantizer is reused until the index grows, and (re)trained on a
+        background thread, so a publish never waits for k-means. Without a usable one the
+        generation has no codes.
+        """
+        if self.quantization != "pq" or not len(vectors):
+            return train_quantizer(self.quantization, vectors, self.pq_subvectors, generation)
+        if not self._pq_loaded:
+            self._pq_loaded = True
+            self._load_saved_pq()
+        width = self._pq.centroids.shape[2] * self._pq.subvectors if self._pq is not None else 0
+        if width != vectors.shape[1]:
+            self._pq = None
+        if self._pq is None or len(vectors) > self._pq_rows * PQ_RETRAIN_GROWTH:
+            self._start_training(vectors, generation)
+        return self._pq
+
+    def _load_saved_pq(self):
+        """Reuse the codebook of the current generation on disk, e.g. after a restart"""
+        gen_dir = self._generation_dir(self.current_generation())
+        try:
+            quantizer = load_quantizer(os.path.join(gen_dir, "quantizer.npz"))
+            rows = int(np.load(os.path.join(gen_dir, "valid.npy")).sum())
+        except (OSError, ValueError):
+            return
+        if isinstance(quantizer, ProductQuantizer):
+            self._pq, self._pq_rows = quantizer, rows
+
+    def _start_training(self, vectors: np.ndarray, generation: int):
+        if self._training is not None and self._training.is_alive():
+            return
+        # The vectors are copied, since the caller's buffer is freed after publishing
+        self._training = threading.Thread(
+            target=self._train_pq, args=(np.array(vectors), generation), name="pq-training", daemon=True
+        )
+        self._training.start()
+
+    def _train_pq(self, vectors: np.ndarray, version: int):
+        """Train a product quantizer and republish the current generation with its codes"""
+        try:
+            start = time.perf_counter()
+            quantizer = ProductQuantizer.train(vectors, self.pq_subvectors, version)
+            logger.info("Trained product quantizer on %d vectors in %.1fs", len(vectors), time.perf_counter() - start)
+            with self.write_lock():
+                self._pq, self._pq_rows = quantizer, len(vectors)
+                # The writer's newest generation, since publishing happens under this lock
+                snapshot = self.snapshot
+                if len(snapshot):
+                    self.publish(snapshot.documents, [
+                        snapshot.matrix[i] if snapshot.valid[i] else None for i in range(len(snapshot))
+                    ])
+        except Exception:
+            logger.exception("Error training product quantizer")
+
+    def wait_for_quantizer(self, timeout: Optional[float] = None):
+        """Wait for a product quantizer being trained, and the generation republished with it"""
+        if self._training is not None:
+            self._training.join(timeout)
+
+    def _encode(self, quantizer, unit: np.ndarray, documents: List[Dict[str, Any]], valid: np.ndarray) -> np.ndarray:
+        """Codes of all rows, copying those of the previous generation when the quantizer is unchanged"""
+        previous = self.snapshot
+        if not isinstance(quantizer, ProductQuantizer) or previous.quantizer is None \
+                or previous.quantizer.kind != quantizer.kind or previous.quantizer.version != quantizer.version:
+            codes = quantizer.encode(unit)
+            codes[~valid] = 0
+            return codes
+
+        # Ids are content hashes, so a document with the same id has the same embedding
+        previous_rows = {doc["id"]: i for i, doc in enumerate(previous.documents) if previous.valid[i]}
+        codes = np.zeros((len(documents), quantizer.subvectors), dtype=np.uint8)
+        reused = [(i, previous_rows[doc["id"]]) for i, doc in enumerate(documents)
+                  if valid[i] and doc["id"] in previous_rows]
+        if reused:
+            rows, previous_indices = (np.array(column) for column in zip(*reused))
+            codes[rows] = previous.codes[previous_indices]
+        unencoded = valid.copy()
+        if reused:
+            unencoded[rows] = False
+        missing = np.flatnonzero(unencoded)
+        if len(missing):
+            codes[missing] = quantizer.encode(unit[missing])
+        return codes
+
+    def _collect_garbage(self, generation: int):
+        for name in os.listdir(self.index_dir):
+            if not name.startswith("gen-"):
+                continue
+            try:
+                number = int(name[4:].split(".")[0])
+            except ValueError:
+                continue
+            if number <= generation - KEEP_GENERATIONS:
+                shutil.rmtree(os.path.join(self.index_dir, name), ignore_errors=True)
+
+    def load(self, generation: Optional[int] = None) -> IndexSnapshot:
+        """Load a generation (the current one by default), memory-mapping its embeddings"""
+        generation = self.current_generation() if generation is None else generation
+        if generation == 0:
+            return IndexSnapshot.empty()
+        gen_dir = self._generation_dir(generation)
+        with open(os.path.join(gen_dir, "documents.json"), "r") as f:
+            documents = json.load(f)
+        # An empty array has nothing to map
+        matrix = np.load(os.path.join(gen_dir, "embeddings.npy"), mmap_mode="r" if documents else None)
+        norms = np.load(os.path.join(gen_dir, "norms.npy"))
+        valid = np.load(os.path.join(gen_dir, "valid.npy"))
+        quantizer, codes = None, None
+        if os.path.exists(os.path.join(gen_dir, "quantizer.npz")):
+            quantizer = load_quantizer(os.path.join(gen_dir, "quantizer.npz"))
+            codes = np.load(os.path.join(gen_dir, "codes.npy"), mmap_mode="r" if documents else None)
+        return IndexSnapshot(generation, documents, matrix, norms, valid, quantizer, codes)
+
+    def _activate(self, snapshot: IndexSnapshot):
+        with self._reload_lock:
+            if snapshot.generation > self.snapshot.generation:
+                self.snapshot = snapshot
+
+    def current(self, force: bool = False) -> IndexSnapshot:
+        """The newest generation, checking the counter at most every reload_interval"""
+        now = time.monotonic()
+        if force or now - self._last_check >= self.reload_interval:
+            self._last_check = now
+            generation = self.current_generation()
+            if generation > self.snapshot.generation:
+                try:
+                    self._activate(self.load(generation))
+                    logger.info("Loaded index generation %d with %d documents", generation, len(self.snapshot))
+                except (OSError, ValueError) as e:
+                    logger.warning("Error loading index generation %d: %s", generation, e)
+        return self.snapshot
@@ -0,0 +1,267 @@
+"""Persistent background job queue for document ingestion.
+
+Jobs and their progress live in a local SQLite database and uploaded files are kept
+next to it, so queued and interrupted jobs are picked up again after a restart.
+A fixed pool of worker threads claims queued jobs and runs them through a handler.
+A job interrupted max_attempts times (e.g. because it crashes the process) is failed
+instead of being retried again, and finished jobs are deleted after retention_seconds.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger("knowledge_base_service.jobs")
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# Seconds between sweeps for finished jobs past their retention
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+class QueueFullError(Exception):
+    """Raised when too many jobs are already waiting"""
+
+
+class Job:
+    """A job as seen by its handler, with a way to report progress"""
+
+    def __init__(self, queue: "JobQueue", row: Dict[str, Any]):
+        self._queue = queue
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.filename = row["filename"]
+        self.content_type = row["content_type"]
+        self.metadata = json.loads(row["metadata"])
+        self.payload_path = row["payload_path"]
+
+    def read_payload(self) -> bytes:
+        with open(self.payload_path, "rb") as f:
+            return f.read()
+
+    def report(self, stage: str, progress: float, **fields):
+        """Record the current stage and progress (0 to 1) of the job"""
+        self._queue.update(self.id, stage=stage, progress=progress, **fields)
+
+
+class JobQueue:
+    """SQLite-backed job queue served by a bounded pool of worker threads"""
+
+    def __init__(self, db_path: str, upload_dir: str, handler: Callable[[Job], Dict[str, Any]],
+                 workers: int = 2, max_pending: int = 100, max_attempts: int = 3,
+                 retention_seconds: float = 7 * 86400):
+        self.db_path = db_path
+        self.upload_dir = upload_dir
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self._last_prune = 0.0
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        os.makedirs(upload_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    filename TEXT,
+                    content_type TEXT,
+                    metadata TEXT NOT NULL,
+                    payload_path TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    @contextmanager
+    def _connect(self):
+        """Short-lived autocommit connection, so every worker thread uses its own"""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def submit(self, kind: str, filename: str, content_type: str, metadata: Dict[str, Any],
+               content: bytes) -> str:
+        """Persist an uploaded file as a queued job and return its id"""
+        if self.pending() >= self.max_pending:
+            raise QueueFullError(f"Too many pending jobs (limit {self.max_pending})")
+        job_id = str(uuid.uuid4())
+        payload_path = os.path.join(self.upload_dir, job_id)
+        with open(payload_path, "wb") as f:
+            f.write(content)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, stage, filename, content_type, metadata, payload_path,"
+                " created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, QUEUED, filename, content_type, json.dumps(metadata),
+                 payload_path, now, now)
+            )
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Public view of a job, or None if it doesn't exist"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "stage": row["stage"],
+            "progress": row["progress"],
+            "filename": row["filename"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def pending(self) -> int:
+        """Number of jobs waiting or running"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+            ).fetchone()[0]
+
+    def update(self, job_id: str, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def prune(self) -> int:
+        """Delete finished jobs last updated more than retention_seconds ago"""
+        self._last_prune = time.monotonic()
+        cutoff = time.time() - self.retention_seconds
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, payload_path FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (COMPLETED, FAILED, cutoff)
+            ).fetchall()
+            for row in rows:
+                _remove_payload(row["payload_path"])
+                conn.execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+        if rows:
+            logger.info("Pruned %d finished jobs", len(rows))
+        return len(rows)
+
+    def _claim(self) -> Optional[Job]:
+        """Atomically move the oldest queued job to running"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (RUNNING, time.time(), row["id"])
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return Job(self, dict(row)) if row is not None else None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                logger.error("Error claiming job: %s", e)
+                job = None
+            if job is None:
+                if time.monotonic() - self._last_prune >= PRUNE_INTERVAL_SECONDS:
+                    try:
+                        self.prune()
+                    except sqlite3.Error as e:
+                        logger.error("Error pruning jobs: %s", e)
+                # Poll as well, so jobs submitted by other processes are seen
+                self._wakeup.wait(timeout=1.0)
+                self._wakeup.clear()
+                continue
+            try:
+                result = self.handler(job)
+                self.update(job.id, status=COMPLETED, stage=COMPLETED, progress=1.0, result=result)
+                logger.info("Job completed", extra={"fields": {"job_id": job.id, "kind": job.kind}})
+            except Exception as e:
+                self.update(job.id, status=FAILED, stage=FAILED, error=str(e))
+                logger.exception("Job failed", extra={"fields": {"job_id": job.id, "kind": job.kind}})
+            finally:
+                _remove_payload(job.payload_path)
+
+    def start(self):
+        """Requeue jobs interrupted by a restart and start the workers.
+
+        Jobs already interrupted max_attempts times are failed instead, so a job that
+        crashes the process isn't retried on every restart.
+        """
+        with self._connect() as conn:
+            abandoned = conn.execute(
+                "SELECT id, payload_path FROM jobs WHERE status = ? AND attempts >= ?", (RUNNING, self.max_attempts)
+            ).fetchall()
+            for row in abandoned:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, stage = ?, error = ?, updated_at = ? WHERE id = ?",
+                    (FAILED, FAILED, f"Interrupted {self.max_attempts} times; giving up", time.time(), row["id"])
+                )
+                _remove_payload(row["payload_path"])
+            requeued = conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, progress = 0 WHERE status = ?", (QUEUED, QUEUED, RUNNING)
+            ).rowcount
+        if abandoned:
+            logger.warning("Failed %d jobs interrupted %d times", len(abandoned), self.max_attempts)
+        if requeued:
+            logger.info("Requeued %d interrupted jobs", requeued)
+        self.prune()
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the workers; a job still running is requeued on the next start"""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+
+def _remove_payload(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
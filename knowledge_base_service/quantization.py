@@ -0,0 +1,165 @@
+"""Compressed vector codes for the search index.
+
+Both quantizers encode unit-length vectors, so the dot product of a code with a unit
+query approximates cosine similarity. They are meant for a first pass that picks a
+shortlist, which is then re-ranked exactly against the float32 vectors.
+
+- ScalarQuantizer: one int8 per dimension with a per-dimension scale (4x smaller than float32)
+- ProductQuantizer: the vector is split into subvectors and each is replaced by the index
+  of its nearest of 256 centroids, one byte per subvector (dim * 4 / subvectors times smaller)
+"""
+from typing import Optional
+
+import numpy as np
+
+# Supported kinds of quantization
+QUANTIZATIONS = ("none", "int8", "pq")
+
+# Rows scored at a time, bounding the float temporaries of a scan
+BLOCK_ROWS = 4096
+
+# Centroids per subvector, so a code fits in one byte
+PQ_CENTROIDS = 256
+# Training sample size and k-means iterations of the product quantizer
+PQ_TRAIN_SAMPLE = 20000
+PQ_ITERATIONS = 12
+
+
+class ScalarQuantizer:
+    """int8 codes with a symmetric scale per dimension"""
+
+    kind = "int8"
+
+    def __init__(self, scales: np.ndarray, version: int = 0):
+        self.scales = scales.astype(np.float32)
+        self.version = version
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, version: int = 0) -> "ScalarQuantizer":
+        scales = np.abs(vectors).max(axis=0) / 127.0
+        scales[scales == 0] = 1.0
+        return cls(scales, version)
+
+    @property
+    def nbytes(self) -> int:
+        return self.scales.nbytes
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(vectors / self.scales), -127, 127).astype(np.int8)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # Folding the scales into the query leaves one int8 x float32 product per row
+        scaled = (query * self.scales).astype(np.float32)
+        out = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), BLOCK_ROWS):
+            out[start:start + BLOCK_ROWS] = codes[start:start + BLOCK_ROWS].astype(np.float32) @ scaled
+        return out
+
+    def save(self, path: str):
+        np.savez(path, kind=self.kind, version=self.version, scales=self.scales)
+
+
+class ProductQuantizer:
+    """One byte per subvector: the index of its nearest k-means centroid"""
+
+    kind = "pq"
+
+    def __init__(self, centroids: np.ndarray, version: int = 0):
+        # (subvectors, centroids, subvector dim)
+        self.centroids = centroids.astype(np.float32)
+        self.version = version
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, subvectors: int, version: int = 0, seed: int = 0) -> "ProductQuantizer":
+        dim = vectors.shape[1]
+        subvectors = subvector_count(dim, subvectors)
+        rng = np.random.default_rng(seed)
+        if len(vectors) > PQ_TRAIN_SAMPLE:
+            vectors = vectors[rng.choice(len(vectors), PQ_TRAIN_SAMPLE, replace=False)]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        k = min(PQ_CENTROIDS, len(vectors))
+        width = dim // subvectors
+        centroids = np.zeros((subvectors, PQ_CENTROIDS, width), dtype=np.float32)
+        for j in range(subvectors):
+            centroids[j, :k] = _kmeans(vectors[:, j * width:(j + 1) * width], k, rng)
+        # With fewer training rows than centroids, the spare slots repeat the first centroid
+        centroids[:, k:] = centroids[:, :1]
+        return cls(centroids, version)
+
+    @property
+    def subvectors(self) -> int:
+        return self.centroids.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.centroids.nbytes
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        width = self.centroids.shape[2]
+        codes = np.empty((len(vectors), self.subvectors), dtype=np.uint8)
+        for start in range(0, len(vectors), BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + BLOCK_ROWS], dtype=np.float32)
+            for j in range(self.subvectors):
+                codes[start:start + BLOCK_ROWS, j] = _nearest(block[:, j * width:(j + 1) * width], self.centroids[j])
+        return codes
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # Dot product of each query subvector with every centroid, summed over the codes
+        tables = np.einsum("mkd,md->mk", self.centroids, query.reshape(self.subvectors, -1).astype(np.float32))
+        columns = np.arange(self.subvectors)
+        out = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), BLOCK_ROWS):
+            out[start:start + BLOCK_ROWS] = tables[columns, codes[start:start + BLOCK_ROWS]].sum(axis=1)
+        return out
+
+    def save(self, path: str):
+        np.savez(path, kind=self.kind, version=self.version, centroids=self.centroids)
+
+
+def subvector_count(dim: int, requested: int) -> int:
+    """The largest number of subvectors up to requested that divides dim evenly"""
+    for count in range(max(1, min(requested, dim)), 0, -1):
+        if dim % count == 0:
+            return count
+    return 1
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the nearest centroid of each vector"""
+    distances = (centroids ** 2).sum(axis=1) - 2.0 * (vectors @ centroids.T)
+    return distances.argmin(axis=1)
+
+
+def _kmeans(vectors: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(PQ_ITERATIONS):
+        assignment = _nearest(vectors, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        for d in range(vectors.shape[1]):
+            sums = np.bincount(assignment, weights=vectors[:, d], minlength=k)
+            # Empty clusters keep their previous centroid
+            centroids[:, d] = np.where(counts > 0, sums / np.maximum(counts, 1), centroids[:, d])
+    return centroids
+
+
+def train_quantizer(kind: str, vectors: np.ndarray, pq_subvectors: int = 96, version: int = 0):
+    """A quantizer of the given kind ("int8" or "pq") fitted to unit vectors, or None for "none" """
+    if kind == "none" or not len(vectors):
+        return None
+    if kind == "int8":
+        return ScalarQuantizer.train(vectors, version)
+    if kind == "pq":
+        return ProductQuantizer.train(vectors, pq_subvectors, version)
+    raise ValueError(f"Unknown quantization {kind!r}; expected one of {', '.join(QUANTIZATIONS)}")
+
+
+def load_quantizer(path: str) -> Optional[object]:
+    """Load a quantizer saved with save()"""
+    with np.load(path) as data:
+        kind = str(data["kind"])
+        version = int(data["version"])
+        if kind == ScalarQuantizer.kind:
+            return ScalarQuantizer(data["scales"], version)
+        if kind == ProductQuantizer.kind:
+            return ProductQuantizer(data["centroids"], version)
+    raise ValueError(f"Unknown quantizer kind {kind!r} in {path}")
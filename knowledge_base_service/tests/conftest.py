@@ -0,0 +1,61 @@
+import hashlib
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The service's modules, and the modules shared by all services
+sys.path.insert(0, os.path.join(os.path.dirname(SERVICE_DIR), "common"))
+sys.path.insert(0, SERVICE_DIR)
+
+EMBEDDING_DIM = 16
+
+
+@pytest.fixture(scope="session")
+def kb_module(tmp_path_factory):
+    """The service's app module, writing its data, index and jobs under a scratch directory"""
+    workdir = tmp_path_factory.mktemp("knowledge_base")
+    os.environ.update({
+        "KB_ROLE": "writer",
+        "INDEX_DIR": str(workdir / "index"),
+        "JOBS_DB_PATH": str(workdir / "jobs.db"),
+        "UPLOAD_DIR": str(workdir / "uploads"),
+    })
+    spec = importlib.util.spec_from_file_location("knowledge_base_app", os.path.join(SERVICE_DIR, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    module.DOCUMENT_PATH = str(workdir / "data" / "documents.json")
+    return module
+
+
+class FakeEmbeddings:
+    """Deterministic unit embeddings derived from the text, counting calls"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, text):
+        self.calls.append(text)
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIM)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+@pytest.fixture
+def kb(kb_module, monkeypatch):
+    """The app module with an empty knowledge base and fake embeddings"""
+    with kb_module.DOCUMENTS_LOCK:
+        kb_module.DOCUMENTS.clear()
+        kb_module.DOCUMENT_INDEX.clear()
+        kb_module.EMBEDDINGS.clear()
+    monkeypatch.setattr(kb_module, "generate_embedding", FakeEmbeddings())
+    return kb_module
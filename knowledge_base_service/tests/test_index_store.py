@@ -0,0 +1,126 @@
+import asyncio
+
+import httpx
+import numpy as np
+import pytest
+
+from index_store import IndexStore
+from quantization import ProductQuantizer, ScalarQuantizer, load_quantizer
+
+DIM = 32
+
+
+def clustered(count, dim=DIM, clusters=20, seed=0):
+    """Unit vectors around a few centres, so neighbours are close and ranking is hard"""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim))
+    vectors = centres[rng.integers(clusters, size=count)] + 0.3 * rng.standard_normal((count, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def publish(tmp_path, vectors, quantization="none", **kwargs):
+    store = IndexStore(str(tmp_path / "index"), quantization=quantization, **kwargs)
+    documents = [{"id": f"doc-{i}", "content": f"document {i}", "metadata": {}} for i in range(len(vectors))]
+    with store.write_lock():
+        store.publish(documents, list(vectors))
+    store.wait_for_quantizer()
+    return store
+
+
+def exact_top(vectors, query, k):
+    scores = vectors @ (query / np.linalg.norm(query))
+    return list(np.argsort(-scores, kind="stable")[:k]), scores
+
+
+@pytest.mark.parametrize("quantizer, min_correlation", [
+    (ScalarQuantizer.train(clustered(2000)), 0.99),
+    (ProductQuantizer.train(clustered(2000), subvectors=8), 0.6),
+])
+def test_quantizer_scores_approximate_dot_products(quantizer, min_correlation, tmp_path):
+    vectors = clustered(500, seed=1)
+    query = clustered(1, seed=2)[0]
+    approximate = quantizer.scores(quantizer.encode(vectors), query)
+    assert np.corrcoef(approximate, vectors @ query)[0, 1] > min_correlation
+
+    quantizer.save(str(tmp_path / "quantizer.npz"))
+    loaded = load_quantizer(str(tmp_path / "quantizer.npz"))
+    assert np.allclose(loaded.scores(loaded.encode(vectors), query), approximate)
+
+
+def test_exact_search_matches_brute_force(tmp_path):
+    vectors = clustered(1000)
+    snapshot = publish(tmp_path, vectors).snapshot
+    query = clustered(1, seed=3)[0]
+    expected, scores = exact_top(vectors, query, 10)
+    results = snapshot.search(query, 10)
+    assert [i for i, _ in results] == expected
+    assert np.allclose([similarity for _, similarity in results], scores[expected], atol=1e-5)
+
+
+@pytest.mark.parametrize("quantization, min_recall", [("int8", 0.98), ("pq", 0.9)])
+def test_quantized_search_with_rerank_recalls_exact_results(tmp_path, quantization, min_recall):
+    vectors = clustered(3000)
+    store = publish(tmp_path, vectors, quantization, pq_subvectors=8)
+    snapshot = store.snapshot
+    assert snapshot.quantization == quantization
+    assert snapshot.search_bytes < vectors.nbytes
+
+    report = snapshot.recall_report(n_results=10, samples=50, rerank_factor=10)
+    assert report["recall"] >= min_recall
+    assert report["recall"] >= report["recall_without_rerank"]
+
+
+def test_rerank_returns_exact_similarities(tmp_path):
+    vectors = clustered(2000)
+    snapshot = publish(tmp_path, vectors, "pq", pq_subvectors=4).snapshot
+    query = clustered(1, seed=4)[0]
+    _, scores = exact_top(vectors, query, 10)
+    for i, similarity in snapshot.search(query, 10, rerank_factor=10):
+        assert similarity == pytest.approx(float(scores[i]), abs=1e-5)
+    # Without re-ranking the scores are the quantizer's approximations
+    approximate = snapshot.search(query, 10, rerank_factor=0)
+    assert any(abs(similarity - scores[i]) > 1e-4 for i, similarity in approximate)
+
+
+def test_pq_codebook_is_trained_in_background_and_republished(tmp_path):
+    vectors = clustered(1000)
+    store = IndexStore(str(tmp_path / "index"), quantization="pq", pq_subvectors=8)
+    documents = [{"id": f"doc-{i}", "content": f"document {i}", "metadata": {}} for i in range(len(vectors))]
+    with store.write_lock():
+        generation = store.publish(documents, list(vectors))
+    # The first generation is searchable right away, exactly
+    assert store.load(generation).quantization == "none"
+
+    store.wait_for_quantizer()
+    assert store.current_generation() == generation + 1
+    assert store.snapshot.quantization == "pq"
+    assert [doc["id"] for doc in store.snapshot.documents] == [doc["id"] for doc in documents]
+
+    # A restarted writer reuses the codebook on disk instead of training again
+    restarted = IndexStore(str(tmp_path / "index"), quantization="pq", pq_subvectors=8)
+    with restarted.write_lock():
+        restarted.publish(documents, list(vectors))
+    assert restarted._training is None
+    assert restarted.snapshot.quantization == "pq"
+
+
+def test_reader_sees_published_generation(tmp_path):
+    vectors = clustered(100)
+    writer = publish(tmp_path, vectors, "int8")
+    reader = IndexStore(str(tmp_path / "index"), reload_interval=0)
+    snapshot = reader.current()
+    assert snapshot.generation == writer.snapshot.generation
+    assert snapshot.quantization == "int8"
+    assert snapshot.search(vectors[7], 1)[0][0] == 7
+
+
+def test_recall_endpoint_rejects_empty_samples(kb):
+    async def statuses():
+        transport = httpx.ASGITransport(app=kb.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://kb") as client:
+            return [
+                (await client.get("/index/recall", params=params)).status_code
+                for params in ({"samples": 0}, {"n_results": 0}, {"samples": 1})
+            ]
+
+    assert asyncio.run(statuses()) == [422, 422, 200]
@@ -0,0 +1,108 @@
+import os
+import time
+
+import pytest
+
+from jobs import COMPLETED, FAILED, QUEUED, RUNNING, JobQueue, QueueFullError
+
+
+def make_queue(tmp_path, handler, **kwargs):
+    return JobQueue(str(tmp_path / "jobs.db"), str(tmp_path / "uploads"), handler, workers=1, **kwargs)
+
+
+def wait_for(queue, job_id, status, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job["status"] == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} is {queue.get(job_id)['status']}, expected {status}")
+
+
+def test_job_runs_and_reports_result(tmp_path):
+    def handler(job):
+        job.report("working", 0.5)
+        return {"length": len(job.read_payload()), "filename": job.filename}
+
+    queue = make_queue(tmp_path, handler)
+    queue.start()
+    try:
+        job_id = queue.submit("text", "a.txt", "text/plain", {}, b"hello")
+        job = wait_for(queue, job_id, COMPLETED)
+    finally:
+        queue.stop()
+    assert job["result"] == {"length": 5, "filename": "a.txt"}
+    assert job["progress"] == 1.0 and job["attempts"] == 1
+    assert os.listdir(tmp_path / "uploads") == []
+
+
+def test_failed_job_records_error_and_removes_payload(tmp_path):
+    def handler(job):
+        raise ValueError("cannot parse")
+
+    queue = make_queue(tmp_path, handler)
+    queue.start()
+    try:
+        job_id = queue.submit("text", "a.txt", "text/plain", {}, b"hello")
+        job = wait_for(queue, job_id, FAILED)
+    finally:
+        queue.stop()
+    assert job["error"] == "cannot parse"
+    assert os.listdir(tmp_path / "uploads") == []
+
+
+def test_interrupted_job_resumes_on_restart(tmp_path):
+    crashed = make_queue(tmp_path, lambda job: None)
+    job_id = crashed.submit("text", "a.txt", "text/plain", {"source_id": "a"}, b"hello")
+    # Claimed by a worker whose process then died mid-job
+    assert crashed._claim().id == job_id
+    assert crashed.get(job_id)["status"] == RUNNING
+
+    restarted = make_queue(tmp_path, lambda job: {"payload": job.read_payload().decode(), **job.metadata})
+    restarted.start()
+    try:
+        job = wait_for(restarted, job_id, COMPLETED)
+    finally:
+        restarted.stop()
+    assert job["result"] == {"payload": "hello", "source_id": "a"}
+    assert job["attempts"] == 2
+
+
+def test_job_interrupted_max_attempts_times_is_failed(tmp_path):
+    queue = make_queue(tmp_path, lambda job: None, max_attempts=2)
+    job_id = queue.submit("text", "a.txt", "text/plain", {}, b"hello")
+    for _ in range(2):
+        assert queue._claim().id == job_id
+        queue.update(job_id, status=QUEUED)
+    queue.update(job_id, status=RUNNING)
+
+    queue.start()
+    queue.stop()
+    job = queue.get(job_id)
+    assert job["status"] == FAILED
+    assert "Interrupted 2 times" in job["error"]
+    assert os.listdir(tmp_path / "uploads") == []
+
+
+def test_prune_deletes_only_expired_finished_jobs(tmp_path):
+    queue = make_queue(tmp_path, lambda job: None, retention_seconds=60)
+    old = queue.submit("text", "old.txt", "text/plain", {}, b"old")
+    recent = queue.submit("text", "recent.txt", "text/plain", {}, b"recent")
+    waiting = queue.submit("text", "waiting.txt", "text/plain", {}, b"waiting")
+    queue.update(old, status=COMPLETED)
+    queue.update(recent, status=FAILED)
+    with queue._connect() as conn:
+        conn.execute("UPDATE jobs SET updated_at = ? WHERE id IN (?, ?)", (time.time() - 120, old, waiting))
+
+    assert queue.prune() == 1
+    assert queue.get(old) is None
+    assert queue.get(recent)["status"] == FAILED
+    assert queue.get(waiting)["status"] == QUEUED
+
+
+def test_submit_rejects_when_queue_is_full(tmp_path):
+    queue = make_queue(tmp_path, lambda job: None, max_pending=1)
+    queue.submit("text", "a.txt", "text/plain", {}, b"a")
+    with pytest.raises(QueueFullError):
+        queue.submit("text", "b.txt", "text/plain", {}, b"b")
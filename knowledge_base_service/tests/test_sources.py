@@ -0,0 +1,158 @@
+import json
+
+import pytest
+from fastapi import HTTPException
+
+
+class FakeJob:
+    """Just enough of a jobs.Job for process_upload"""
+
+    def __init__(self, job_id, filename, text, metadata=None):
+        self.id = job_id
+        self.kind = "text"
+        self.filename = filename
+        self.content_type = "text/plain"
+        self.metadata = metadata or {}
+        self._payload = text.encode("utf-8")
+
+    def read_payload(self):
+        return self._payload
+
+    def report(self, stage, progress, **fields):
+        pass
+
+
+def paragraphs(*names):
+    return "\n\n".join(f"Paragraph about {name}." for name in names)
+
+
+def stored_contents(kb):
+    return sorted(doc["content"] for doc in kb.DOCUMENTS)
+
+
+def test_content_id_ignores_whitespace_and_unicode_form(kb):
+    assert kb.content_id("neural  networks\n") == kb.content_id("neural networks")
+    assert kb.content_id("ﬁne tuning") == kb.content_id("fine tuning")
+    assert kb.content_id("neural networks") != kb.content_id("neural network")
+
+
+def test_chunk_text_packs_whole_paragraphs_up_to_chunk_size(kb):
+    text = "\n\n".join(["a" * 40, "b" * 40, "c" * 40])
+    assert kb.chunk_text(text, chunk_size=90) == ["a" * 40 + "\n\n" + "b" * 40, "c" * 40]
+
+
+def test_chunk_text_edit_only_changes_its_chunk(kb):
+    before = kb.chunk_text("\n\n".join(["a" * 40, "b" * 40, "c" * 40, "d" * 40]), chunk_size=90)
+    after = kb.chunk_text("\n\n".join(["a" * 40, "b" * 40, "c" * 39 + "x", "d" * 40]), chunk_size=90)
+    assert before[0] == after[0]
+    assert before[1] != after[1]
+
+
+def test_split_long_text_overlaps_on_word_boundaries(kb):
+    words = [f"word{i}" for i in range(200)]
+    chunks = kb.split_long_text(" ".join(words), chunk_size=100, overlap=20)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert all(set(chunk.split()) <= set(words) for chunk in chunks)
+    # Consecutive chunks share some words and together cover the text
+    assert all(set(a.split()) & set(b.split()) for a, b in zip(chunks, chunks[1:]))
+    assert set(" ".join(chunks).split()) == set(words)
+
+
+def test_ingest_deduplicates_identical_content(kb):
+    first = kb.ingest_content("Gradient descent", {"title": "a"})
+    second = kb.ingest_content("  Gradient   descent ", {"title": "b"})
+    assert first["message"] == "Document added successfully"
+    assert second == {"message": "Document already exists", "id": first["id"]}
+    assert len(kb.DOCUMENTS) == 1
+    assert len(kb.generate_embedding.calls) == 1
+
+
+def test_sync_source_only_embeds_changed_chunks(kb):
+    first = kb.sync_source("notes", kb.chunk_text(paragraphs("a", "b"), chunk_size=30), {})
+    assert (first["added"], first["unchanged"], first["removed"]) == (2, 0, 0)
+
+    kb.generate_embedding.calls.clear()
+    second = kb.sync_source("notes", kb.chunk_text(paragraphs("a", "c"), chunk_size=30), {})
+    assert (second["added"], second["unchanged"], second["removed"]) == (1, 1, 1)
+    assert kb.generate_embedding.calls == ["Paragraph about c."]
+    assert stored_contents(kb) == ["Paragraph about a.", "Paragraph about c."]
+
+
+def test_shared_chunk_survives_until_its_last_source_is_deleted(kb):
+    kb.sync_source("one", kb.chunk_text(paragraphs("shared", "one"), chunk_size=30), {})
+    kb.generate_embedding.calls.clear()
+    result = kb.sync_source("two", kb.chunk_text(paragraphs("shared", "two"), chunk_size=30), {})
+    assert result["unchanged"] == 1
+    assert kb.generate_embedding.calls == ["Paragraph about two."]
+
+    assert kb.remove_source("one")["removed"] == 1
+    assert stored_contents(kb) == ["Paragraph about shared.", "Paragraph about two."]
+    assert kb.remove_source("two")["removed"] == 2
+    assert kb.DOCUMENTS == []
+    assert kb.remove_source("two") is None
+
+
+def test_deleting_source_keeps_directly_ingested_content(kb):
+    kb.ingest_content("Paragraph about a.", {})
+    kb.sync_source("a.txt", ["Paragraph about a."], {})
+    kb.remove_source("a.txt")
+    assert stored_contents(kb) == ["Paragraph about a."]
+
+
+def test_ingesting_synced_content_keeps_it_after_source_is_deleted(kb):
+    kb.sync_source("a.txt", ["Paragraph about a."], {})
+    assert kb.ingest_content("Paragraph about a.", {})["message"] == "Document already exists"
+    kb.remove_source("a.txt")
+    assert stored_contents(kb) == ["Paragraph about a."]
+
+
+def test_sync_source_handles_documents_without_metadata(kb):
+    kb.ingest_content("Paragraph about a.", None)
+    result = kb.sync_source("a.txt", ["Paragraph about a."], {})
+    assert result["unchanged"] == 1
+    doc = kb.DOCUMENTS[0]
+    assert doc["metadata"]["sources"] == [kb.DIRECT_SOURCE, "a.txt"]
+
+
+def test_upload_without_source_id_never_replaces_earlier_uploads(kb):
+    kb.process_upload(FakeJob("job-1", "notes.txt", paragraphs("first")))
+    kb.process_upload(FakeJob("job-2", "notes.txt", paragraphs("second")))
+    assert stored_contents(kb) == ["Paragraph about first.", "Paragraph about second."]
+
+
+def test_upload_with_source_id_replaces_previous_version(kb):
+    kb.process_upload(FakeJob("job-1", "notes.txt", paragraphs("first"), {"source_id": "notes"}))
+    result = kb.process_upload(FakeJob("job-2", "notes-v2.txt", paragraphs("second"), {"source_id": "notes"}))
+    assert result["source_id"] == "notes" and result["removed"] == 1
+    assert stored_contents(kb) == ["Paragraph about second."]
+
+
+def test_direct_source_id_is_reserved(kb):
+    with pytest.raises(HTTPException) as error:
+        kb.check_source_id(kb.DIRECT_SOURCE)
+    assert error.value.status_code == 400
+    with pytest.raises(HTTPException):
+        kb.parse_metadata(json.dumps({"source_id": kb.DIRECT_SOURCE}))
+
+
+def test_rekey_documents_moves_legacy_ids_to_content_hashes(kb):
+    legacy = [
+        {"id": "uuid-1", "content": "Paragraph about a.", "metadata": None, "embedding": None},
+        {"id": "uuid-2", "content": "Paragraph  about a.", "metadata": {"sources": ["a.txt"]}, "embedding": [1.0]},
+        {"id": kb.content_id("Paragraph about b."), "content": "Paragraph about b.", "metadata": {}, "embedding": [2.0]},
+    ]
+    documents, changed = kb.rekey_documents(legacy)
+    assert changed == 2
+    assert [doc["id"] for doc in documents] == [kb.content_id("Paragraph about a."), kb.content_id("Paragraph about b.")]
+    # The duplicate is merged, keeping its origin and embedding
+    assert documents[0]["metadata"]["sources"] == [kb.DIRECT_SOURCE, "a.txt"]
+    assert documents[0]["embedding"] == [1.0]
+
+
+def test_save_documents_round_trips_through_rekey(kb):
+    kb.ingest_content("Paragraph about a.", {})
+    with open(kb.DOCUMENT_PATH) as f:
+        documents, changed = kb.rekey_documents(json.load(f))
+    assert changed == 0
+    assert [doc["id"] for doc in documents] == [kb.content_id("Paragraph about a.")]
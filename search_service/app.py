@@ -5,6 +5,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from duckduckgo_search import DDGS
 from dotenv import load_dotenv
+from instrumentation import install, stage
+from structured_logging import install_logging
 
 # Load environment variables
 load_dotenv()
@@ -25,6 +27,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request metrics, Server-Timing headers, tracing and /metrics
+install(app, "search_service")
+
+# Structured JSON logging with request id correlation
+logger = install_logging(app, "search_service")
+
 # Models
 class SearchRequest(BaseModel):
     query: str
@@ -47,7 +55,8 @@ async def root():
     return {
         "message": "Search Service API",
         "endpoints": {
-            "/search": "Search the web using DuckDuckGo"
+            "/search": "Search the web using DuckDuckGo",
+            "/metrics": "Prometheus metrics"
         }
     }
 
@@ -59,13 +68,14 @@ async def search(request: SearchRequest):
         ddgs = DDGS()
         
         # Perform the search
-        results = ddgs.text(
-            keywords=request.query,
-            region=request.region,
-            safesearch=request.safesearch,
-            timelimit=request.timelimit,
-            max_results=request.max_results
-        )
+        with stage("ddg_search"):
+            results = ddgs.text(
+                keywords=request.query,
+                region=request.region,
+                safesearch=request.safesearch,
+                timelimit=request.timelimit,
+                max_results=request.max_results
+            )
         
         # Format the response
         search_results = []
@@ -79,6 +89,7 @@ async def search(request: SearchRequest):
         
         return SearchResponse(results=search_results)
     except Exception as e:
+        logger.warning("Error searching the web: %s", e)
         raise HTTPException(status_code=500, detail=f"Error searching the web: {str(e)}")
 
 if __name__ == "__main__":